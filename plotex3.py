@@ -5,13 +5,34 @@
 #
 # For a full description, see <http://eblong.com/zarf/plotex/>
 
-# This is the Python 3 version. (Auto-generated by 2to3.)
+# This is the Python 3 version. (Originally auto-generated by 2to3; the
+# performance options are only available in this version.)
 # If you have Python 3 installed, you'll have to copy plotex3.py over
 # plotex.py, or else change the "import plotex" lines in the examples to
 # "import plotex3".
 
 import sys
+import os
 import optparse
+import pickle
+import hashlib
+import inspect
+import collections
+import heapq
+import itertools
+import multiprocessing
+import json
+import array
+import bisect
+import random
+import sqlite3
+import time
+
+# numpy is only needed for the --npz export.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TrackMetaClass(type):
     '''TrackMetaClass does some Python magic to catalog the members of a
@@ -53,6 +74,13 @@ class TrackMetaClass(type):
         cls._testmap = tests
         cls._typemap = types
         cls._sensemap = senses
+        cls._codec = None
+        cls._actioncache = None
+        cls._symmetry = None
+        cls._statetable = None
+        cls._zobrist = None
+        cls._profile = None
+        cls._inferred = None
         
         for val in list(states.values()):
             val.scenario = cls
@@ -170,91 +198,408 @@ class Graph:
         self.statels = []
         self.seenmaxes = set()
         self.maxls = []
+        self.edgetable = EdgeTable()
+        self.idstates = self.edgetable.states
+        self.improveindex = None
+        self.changeindex = None
+        self.prior = None
+        self.dominance = None
+        self.pruned = set()
+        self.symmetry = None
+        self.symactions = None
+        self.sleepsets = None
+        self.goal = None
+        self.reach = None
+        self.spill = None
+        self.saturate = None
+        self.sparse = False
 
-    def run(self, actions, limit=10000, noopt=False):
+    def run(self, actions, limit=10000, noopt=False, frontier='bfs', workers=1, index=False, prior=None, prune=False, partialorder=False, goal=None, reach=None, spill=0, saturate=False, sparse=False, fixed=()):
         '''run(): Do the run. The results are stored within the Graph.
+
+        The frontier argument picks the order in which maximal states are
+        expanded: a key of FRONTIER_POLICIES, or a Frontier class.
+
+        If workers is more than 1, the change actions (and the maximal
+        states they lead to) are worked out by a pool of worker processes,
+        a batch of frontier states at a time. The results are merged in
+        the same order as a serial run, so the graph is exactly the same.
+
+        If index is true, the run uses an ActionIndex to skip actions
+        which can't apply, or which can't have changed their outcome
+        since the previous state in an improvement chain.
+
+        If prior is a PriorRun (the results of an earlier run, before
+        some actions were edited), improvement steps which can't have
+        been affected by the edits are taken from it.
+
+        If prune is true, a newly-reached maximal state which is worse
+        than one we've already seen is left out of the graph (and not
+        expanded). Its state is noted in the pruned set. This changes
+        the results, but any state reachable from the pruned one has a
+        counterpart at least as good reachable from the better state --
+        as long as the actions are monotone, which is what "can" tests
+        generally care about.
+
+        If partialorder is true, the run uses SleepSets to avoid trying
+        independent change actions in every order. Every maximal state is
+        still found, but some edges between them are left out.
+
+        If goal is given (a TestGoal), the run is best-first: states that
+        look closer to the goal are expanded first (the frontier argument
+        is ignored). The run stops as soon as the goal is reached, so the
+        graph may be incomplete.
+
+        If reach is given (a RegressionSearch), maximal states which
+        can't lead to its goal are left out, like dominated states.
+
+        If spill is more than zero, the graph's nodes are kept in a
+        SpillStore, which holds about that many in memory and puts the
+        rest in a temporary database on disk. This is slower, but the
+        run isn't limited by memory. (The limit argument still applies.)
+
+        If saturate is true, maximal states are found with
+        saturate_state() rather than by the usual improvement chains.
+        This may find different maximal states. (The worker processes
+        only build ordinary chains, so this can't be combined with
+        workers.) If sparse is also true, the graph leaves out the
+        states in the middle of each chain; they're needed by tests
+        (which look at every state), but not to display maximal states.
+
+        If the scenario has a Symmetry, fixed is the set of qualities
+        which the tests or filters look at; they're left out of the
+        symmetry groups, since canonical states may not have them. If
+        fixed is None, the run doesn't use symmetry at all.
         '''
+        if (saturate and workers > 1):
+            raise Exception('A saturating run cannot use worker processes')
+        self.use_symmetry(actions, fixed)
+        if (self.scenario._statetable is not None):
+            self.startstates = [ self.scenario._statetable.intern(state) for state in self.startstates ]
+        if (spill > 0):
+            self.spill = SpillStore(self.scenario, actions, spill, self.edgetable)
+            self.states = self.spill
+            self.statels = self.spill.statels
         improveactions = actions
         changeactions = actions
         if (not noopt):
             improveactions = [ action for action in actions if (action.equivtype != EQUIV_LOSS) ]
             changeactions = [ action for action in actions if (action.equivtype in (EQUIV_LOSS, EQUIV_UNKNOWN)) ]
             #print '%d actions filtered to %d improve, %d change' % (len(actions), len(improveactions), len(changeactions))
+        improveactions = self.bind(improveactions)
+        changeactions = self.bind(changeactions)
+        if (index):
+            self.improveindex = ActionIndex(self.scenario, improveactions)
+            self.changeindex = ActionIndex(self.scenario, changeactions)
+        if (saturate):
+            self.saturate = (self.improveindex or ActionIndex(self.scenario, improveactions))
+            self.sparse = sparse
+        if (prune):
+            self.dominance = DominanceIndex(self.scenario)
+        self.reach = reach
+        if (partialorder):
+            self.sleepsets = SleepSets(self.scenario, improveactions, changeactions, self.symmetry)
+        if (prior is not None):
+            prior.bind(improveactions)
+            self.prior = prior
         
-        newstates = []
+        profile = self.scenario._profile
+        if (profile is not None):
+            self.find_maximal_state = profile.timed('improve', self.find_maximal_state)
+
+        if (goal is not None):
+            self.goal = goal
+            frontier = lambda: GoalFrontier(lambda state: goal.score(self, state))
+        elif (isinstance(frontier, str)):
+            frontier = FRONTIER_POLICIES[frontier]
+        newstates = frontier()
         for state in self.startstates:
-            newstate = self.find_maximal_state(state, improveactions)
+            newstate = self.find_maximal_state(state, improveactions, self.improveindex)
             if (newstate in newstates):
                 continue
-            newstates.append(newstate)
-            self.seenmaxes.add(newstate)
-            newnode = self.states[newstate]
+            newstates.push(newstate)
+            newnode = self.add_maximal_state(newstate)
             newnode.history = self.states[state].maxing_actions
+            if (self.sleepsets is not None):
+                self.sleepsets.sleep[newstate] = 0
+
+        pool = None
+        if (workers > 1):
+            pool = start_pool(workers, (self.scenario, improveactions, changeactions))
+        try:
+            if (profile is None):
+                self.expand_all(newstates, improveactions, changeactions, limit, pool, workers*8)
+            else:
+                start = time.perf_counter()
+                improvetime = profile.phases['improve']
+                self.expand_all(newstates, improveactions, changeactions, limit, pool, workers*8)
+                improvetime = profile.phases['improve'] - improvetime
+                profile.addtime('change', time.perf_counter() - start - improvetime)
+        finally:
+            if (pool is not None):
+                stop_pool(pool)
+        if (self.sleepsets is not None):
+            for state in self.maxls:
+                self.states[state].slept = bool(self.sleepsets.sleep.get(state))
+        if (self.spill is not None):
+            self.spill.trim()
+        if (profile is not None):
+            profile.addgraph(self)
 
+    def use_symmetry(self, actions, fixed=()):
+        '''If the scenario has a Symmetry, work out the symmetry groups
+        for this list of actions, and put the start states in canonical
+        form. The qualities in fixed are left out of the groups; if
+        fixed is None, the run doesn't use symmetry at all.
+        '''
+        if (self.scenario._symmetry is None or fixed is None):
+            return
+        self.symmetry = self.scenario._symmetry.forrun(actions, fixed)
+        if (self.symmetry is None):
+            return
+        self.symactions = actions
+        startstates = []
+        for state in self.startstates:
+            state = self.symmetry.canonical(state)
+            if (state not in startstates):
+                startstates.append(state)
+        self.startstates = startstates
+
+    def history(self, node):
+        '''Return the history of a node, as a list of actions. In a run
+        with symmetry groups, each recorded step was taken from a
+        canonical state, so the history is replayed (see
+        Symmetry.replay) to get one which really follows on.
+        '''
+        if (self.symmetry is None):
+            return node.history
+        return self.symmetry.replay(self.startstates, node.history, self.symactions)
+
+    def bind(self, actions):
+        '''Return a list of (action, func) pairs, where func is what we
+        actually call to carry out the action (see actfunc). The run
+        loops work on these lists.
+        '''
+        return [ (action, self.actfunc(action)) for action in actions ]
+
+    def actfunc(self, action):
+        '''Return the callable which carries out an action: its compiled
+        form, if it has one, or else the action itself. If the scenario
+        has an ActionCache, the call goes through that. If the run has
+        symmetry groups, the result is put in canonical form. (This is
+        outside the cache, which every run on the scenario shares, and
+        runs may have different groups.) If the scenario has a
+        StateTable, the result is interned. If the scenario has a
+        RunProfile, the call is counted and timed.
+        '''
+        func = (action.compiled or action)
+        cache = self.scenario._actioncache
+        if (cache is not None):
+            func = cache.wrap(action, func)
+        if (self.symmetry is not None):
+            func = self.symmetry.wrap(func)
+        if (self.scenario._statetable is not None):
+            func = self.scenario._statetable.wrap(func)
+        profile = self.scenario._profile
+        if (profile is not None):
+            func = profile.wrap(action, func)
+        return func
+
+    def expand_all(self, newstates, improveactions, changeactions, limit, pool=None, batchsize=1):
+        '''The main loop of run(). Expand states from the frontier until
+        there are none left.
+        '''
+        expansions = {}
         while (newstates):
+            if (self.spill is not None):
+                # No nodes are held across loop iterations, so this is
+                # a safe time to write some out.
+                self.spill.trim()
+            if (self.goal is not None and self.goal.reached(self)):
+                break
             if (len(self.seenmaxes) >= limit):
                 raise Exception('More than %d states!' % (limit,))
             
-            oldstate = newstates.pop(0)
+            oldstate = newstates.pop()
             oldnode = self.states[oldstate]
-            self.maxls.append(oldstate)
+            sleepsets = self.sleepsets
+            awake = -1
+            if (sleepsets is not None):
+                (awake, first) = sleepsets.start(oldstate)
+                if (first):
+                    self.maxls.append(oldstate)
+            else:
+                self.maxls.append(oldstate)
+            done = 0
+
+            results = None
+            if (pool is not None):
+                results = expansions.pop(oldstate, None)
+                if (results is None):
+                    batch = [oldstate] + newstates.peek(batchsize-1)
+                    resls = pool.map(expand_state_worker, [ state.dic for state in batch ], 4)
+                    for (state, val) in zip(batch[1:], resls[1:]):
+                        expansions[state] = val
+                    results = resls[0]
             
-            for action in changeactions:
-                newstate = action(oldstate)
-                if (not newstate):
+            if (self.changeindex is None):
+                positions = range(len(changeactions))
+            else:
+                positions = self.changeindex.candidates(oldstate)
+            for pos in positions:
+                if (not (awake >> pos) & 1):
                     continue
-                maxstate = self.find_maximal_state(newstate, improveactions)
+                (action, func) = changeactions[pos]
+                if (results is None):
+                    newstate = func(oldstate)
+                    if (not newstate):
+                        continue
+                    maxstate = self.find_maximal_state(newstate, improveactions, self.improveindex)
+                else:
+                    if (results[pos] is None):
+                        continue
+                    (newstate, maxstate) = self.merge_chain(results[pos], improveactions)
+                if (sleepsets is not None and maxstate not in self.pruned):
+                    if (sleepsets.visit(maxstate, oldstate, pos, done) and maxstate not in newstates):
+                        newstates.push(maxstate)
                 if (maxstate == oldstate):
                     continue
-                if (maxstate in oldnode.ancestors):
+                maxnode = self.states[maxstate]
+                if (maxnode.index is not None and (oldnode.ancestry >> maxnode.index) & 1):
                     continue
 
                 aclist = (action,) + self.states[newstate].maxing_actions
-                maxnode = self.states[maxstate]
 
-                if (maxstate in self.seenmaxes):
-                    maxnode.ancestors.update(oldnode.ancestors)
-                    maxnode.ancestors.add(oldstate)
-                else:
-                    newstates.append(maxstate)
-                    self.seenmaxes.add(maxstate)
+                if (maxstate not in self.seenmaxes):
+                    if (self.dominance is not None and self.dominance.dominated(maxstate)):
+                        self.pruned.add(maxstate)
+                        continue
+                    if (self.reach is not None and not self.reach.can_reach(maxstate)):
+                        self.pruned.add(maxstate)
+                        continue
+                    newstates.push(maxstate)
+                    self.add_maximal_state(maxstate)
                     maxnode.history = oldnode.history + aclist
-                    maxnode.ancestors.update(oldnode.ancestors)
-                    maxnode.ancestors.add(oldstate)
+                maxnode.ancestry |= oldnode.ancestry | (1 << oldnode.index)
 
-                oldnode.children.append( (aclist, maxstate) )
-                maxnode.parents.append( (aclist, oldstate) )
+                oldnode.add_child(aclist, maxstate)
+                maxnode.add_parent(aclist, oldstate)
+                done |= (1 << pos)
             
-    def find_maximal_state(self, state, actions):
+    def merge_chain(self, chain, actions):
+        '''Install a chain of improvements which was worked out elsewhere
+        (by expand_state_worker), building exactly the nodes that
+        find_maximal_state() would have built. The chain argument is a
+        list of state dicts and a list of indexes into actions (a bound
+        list; see bind()). Return
+        the first state of the chain and its maximal state.
+        '''
+        (dicls, acposls) = chain
+        actchain = [ actions[pos][0] for pos in acposls ]
+        statechain = []
+        for dic in dicls:
+            state = make_state(self.scenario, dic)
+            gotnode = self.states.get(state)
+            if (gotnode):
+                pos = 0
+                for newstate in statechain:
+                    newnode = self.states[newstate]
+                    newnode.maximal = gotnode.maximal
+                    newnode.maxing_actions = tuple(actchain[pos:len(statechain)]) + gotnode.maxing_actions
+                    pos = pos+1
+                if (not statechain):
+                    return (state, gotnode.maximal)
+                return (statechain[0], gotnode.maximal)
+            self.states[state] = GraphNode(state, self.edgetable)
+            self.statels.append(state)
+            statechain.append(state)
+        pos = 0
+        for newstate in statechain:
+            newnode = self.states[newstate]
+            newnode.maximal = state
+            newnode.maxing_actions = tuple(actchain[pos:])
+            pos = pos+1
+        self.states[state].is_maximal = True
+        return (statechain[0], state)
+
+    def add_maximal_state(self, state):
+        '''Record a newly-reached maximal state, giving it the next node
+        index. Return its node.
+        '''
+        node = self.states[state]
+        node.index = self.edgetable.addstate(state)
+        self.seenmaxes.add(state)
+        if (self.dominance is not None):
+            self.dominance.add(state)
+        return node
+
+    def stats(self):
+        '''Return a dict describing the size of the graph: the number of
+        nodes (states), maximal states, edges, and pruned states.
+        '''
+        edges = 0
+        for state in self.idstates:
+            outs = self.states[state].outs
+            if (outs):
+                edges = edges + len(outs)//2
+        return {
+            'nodes': len(self.states),
+            'maximal': len(self.seenmaxes),
+            'edges': edges,
+            'pruned': len(self.pruned),
+        }
+
+    def find_maximal_state(self, state, actions, index=None):
         '''Do every possible actions that is strictly an improvement --
         that is, every action that produces a better state. Return the
         resulting state.
+
+        If an ActionIndex is given, actions which failed to improve one
+        state in the chain are not retried on the next, unless they
+        touch a quality that changed in between. If the graph has a
+        PriorRun, its steps are used where they're still valid. (Either
+        way, the result is the same.)
+
+        If the run saturates, this hands off to saturate_state().
         '''
+        if (self.saturate is not None):
+            return self.saturate_state(state, actions, self.saturate)
         node = self.states.get(state)
         if (node):
             return node.maximal
             
         statechain = []
         actchain = []
+        inert = set()
         while True:
-            node = GraphNode(state)
+            node = GraphNode(state, self.edgetable)
             self.states[state] = node
             self.statels.append(state)
             statechain.append(state)
+
+            positions = None
+            if (self.prior is not None):
+                positions = self.prior.positions(state)
+            if (positions is not None):
+                pass
+            elif (index is None):
+                positions = range(len(actions))
+            else:
+                positions = [ pos for pos in index.candidates(state) if pos not in inert ]
             
             found_improvement = False
-            for action in actions:
-                newstate = action(state)
-                if (not newstate):
-                    continue
-                if (newstate == state):
-                    continue
-                if not(newstate > state):
+            for pos in positions:
+                (action, func) = actions[pos]
+                newstate = func(state)
+                if (not newstate or newstate == state or not(newstate > state)):
+                    inert.add(pos)
                     continue
                 
                 # That action was an improvement
                 actchain.append(action)
                 found_improvement = True
+                if (index is not None):
+                    inert.difference_update(index.touched(state, newstate))
                 
                 if (newstate in self.states):
                     # We've run into a known state. (Might be maximal, or
@@ -284,46 +629,141 @@ class Graph:
                 return state
                 
 
+    def saturate_state(self, state, actions, index):
+        '''Find a maximal state with a worklist, rather than by rescanning
+        the action list after every step. Every improving action is
+        applied as it comes up; after a step, only the actions which read
+        or write a changed quality (according to the ActionIndex) go back
+        on the list. When the list runs dry, no action can improve the
+        state. Return the resulting state.
+
+        Each state of the chain gets a node, as in find_maximal_state().
+        If the run is sparse, only the first and last do; the first
+        records the whole chain as its maxing_actions.
+        '''
+        node = self.states.get(state)
+        if (node):
+            return node.maximal
+
+        statechain = [ state ]
+        actchain = []
+        tail = ()
+        work = collections.deque(index.candidates(state))
+        queued = set(work)
+        maxstate = None
+        while (work):
+            pos = work.popleft()
+            queued.discard(pos)
+            (action, func) = actions[pos]
+            newstate = func(state)
+            if (not newstate or newstate == state or not(newstate > state)):
+                continue
+            actchain.append(action)
+            gotnode = self.states.get(newstate)
+            if (gotnode):
+                # We've run into a known state.
+                maxstate = gotnode.maximal
+                tail = gotnode.maxing_actions
+                break
+            for newpos in index.touched(state, newstate):
+                if (newpos not in queued):
+                    work.append(newpos)
+                    queued.add(newpos)
+            state = newstate
+            statechain.append(state)
+
+        ismaximal = (maxstate is None)
+        if (ismaximal):
+            maxstate = state
+        positions = range(len(statechain))
+        if (self.sparse):
+            positions = [ 0 ]
+            if (ismaximal and len(statechain) > 1):
+                positions.append(len(statechain)-1)
+        for pos in positions:
+            newstate = statechain[pos]
+            node = GraphNode(newstate, self.edgetable)
+            self.states[newstate] = node
+            self.statels.append(newstate)
+            node.maximal = maxstate
+            node.maxing_actions = tuple(actchain[pos:]) + tail
+            if (ismaximal and pos == len(statechain)-1):
+                node.is_maximal = True
+        return maxstate
+
+    def save(self, filename, fingerprint, signatures=None):
+        '''Write the results of the run to a file, tagged with the run's
+        fingerprint (see run_fingerprint) and the signatures of its
+        actions (see action_signatures). States are stored as dicts and
+        actions by name, so the file doesn't depend on the scenario
+        classes being picklable. Use load_graph() to read it back.
+        '''
+        statepos = {}
+        for (pos, state) in enumerate(self.statels):
+            statepos[state] = pos
+        nodes = [ pack_node(self.states[state], statepos.__getitem__) for state in self.statels ]
+        data = {
+            'version': SAVE_VERSION,
+            'fingerprint': fingerprint,
+            'signatures': (signatures or {}),
+            'states': [ state.dic for state in self.statels ],
+            'nodes': nodes,
+            'maxls': [ statepos[state] for state in self.maxls ],
+            'idstates': [ statepos[state] for state in self.idstates ],
+            'pruned': [ statepos[state] for state in self.pruned ],
+        }
+        tmpname = filename + '.tmp'
+        fl = open(tmpname, 'wb')
+        try:
+            pickle.dump(data, fl, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fl.close()
+        os.replace(tmpname, filename)
+
+    def restore(self, data, actions, fixed=()):
+        '''Fill in an empty Graph from data written by save(). The actions
+        list (and fixed) must be the same as the saved run used.
+        '''
+        self.use_symmetry(actions, fixed)
+        actionmap = {}
+        for action in actions:
+            actionmap[action.name] = action
+        def acts(names):
+            return tuple([ actionmap[name] for name in names ])
+        statels = [ make_state(self.scenario, dic) for dic in data['states'] ]
+        for pos in data['idstates']:
+            self.edgetable.addstate(statels[pos])
+        for (state, val) in zip(statels, data['nodes']):
+            self.states[state] = unpack_node(state, val, acts, statels.__getitem__, self.edgetable)
+        self.statels = statels
+        self.maxls = [ statels[pos] for pos in data['maxls'] ]
+        self.seenmaxes = set(self.idstates)
+        self.pruned = set([ statels[pos] for pos in data['pruned'] ])
+
     def has(self, state):
         return state in self.states
 
-    def showlist(self, showmed=True, filters=[], histories=[]):
-        outls = []
-        
-        for state in self.maxls:
-            node = self.states[state]
-            if (not showmed):
-                if (node.children):
-                    continue
-            filtered = False
-            for filter in filters:
-                if (filter not in state.dic):
-                    filtered = True
-            if (filtered):
-                continue
-            for histac in histories:
-                if (histac not in node.history):
-                    filtered = True
-            if (filtered):
-                continue
-            outls.append(state)
+    def passes(self, state, showmed=True, filters=[], histories=[]):
+        '''Return whether a maximal state should be displayed, given the
+        display options.
+        '''
+        node = self.states[state]
+        if (not showmed):
+            if (not node.is_terminal()):
+                return False
+        for filter in filters:
+            if (filter not in state.dic):
+                return False
+        for histac in histories:
+            if (histac not in node.history):
+                return False
+        return True
 
-        trumped = None
-        if (len(outls) <= 20):
-            trumped = set()
-            for state1 in outls:
-                if (state1 in trumped):
-                    continue
-                for state2 in outls:
-                    if (state2 in trumped):
-                        continue
-                    if (state1 == state2):
-                        continue
-                    if (state2 < state1):
-                        trumped.add(state2)
+    def showlist(self, showmed=True, filters=[], histories=[]):
+        outls = [ state for state in self.maxls if self.passes(state, showmed, filters, histories) ]
 
+        trumped = find_trumped(self.scenario, outls)
         return (outls, trumped)
-    
     def display(self, showmed=False, showin=False, showout=False, showdiff=False, showcount=False, filters=[], histories=[]):
         (outls, trumped) = self.showlist(showmed, filters, histories)
 
@@ -345,9 +785,9 @@ class Graph:
                     print(val+str(state))
                 else:
                     print(val+state.printdiff(difffrom))
-                acs = [ ac.name for ac in node.history]
-                print('  (%d): %s' % (len(node.history), ', '.join(acs),))
-                #print '  ### ancs:', list(node.ancestors)
+                history = self.history(node)
+                acs = [ ac.name for ac in history ]
+                print('  (%d): %s' % (len(history), ', '.join(acs),))
                 if (showin):
                     subls = [ '<= %s : %s' % (substate, ', '.join([ ac.name for ac in acls ])) for (acls, substate) in node.parents ]
                     for val in subls:
@@ -374,108 +814,887 @@ class Graph:
         #print '### (%d intermediate states)' % (len(self.states),)
         print(summary, 'reached')
                     
+    def exportlist(self, filters=[], histories=[]):
+        '''Work out what goes in an exported graph file: the start states
+        which aren't maximal, followed by all the maximal states. Returns
+        a list of (state, node, colored) tuples, and a dict mapping each
+        of those states to its position in the list (counting from zero).
+        A state is colored if it passes the filters and histories
+        (unless they're empty, or everything passes them).
+        '''
+        outls = [ state for state in self.startstates if not self.states[state].is_maximal ]
+        outls.extend(self.maxls)
+        colorset = set()
+        if (filters or histories):
+            colorset = set([ state for state in self.maxls if self.passes(state, True, filters, histories) ])
+            if (len(colorset) >= len(self.maxls)):
+                colorset = set()
+        positions = {}
+        ls = []
+        for (pos, state) in enumerate(outls):
+            positions[state] = pos
+            ls.append( (state, self.states[state], (state in colorset)) )
+        return (ls, positions)
+
+    def exportedges(self, node, positions):
+        '''Return the edges out of an exported node, as a list of
+        (actions, position, improve) tuples. A maximal state has an edge to
+        each of its children; a non-maximal start state has one improve
+        edge, to its maximal state.
+        '''
+        if (node.is_maximal):
+            return [ (acls, positions[child], False) for (acls, child) in node.children ]
+        return [ (node.maxing_actions, positions[node.maximal], True) ]
+
     def writegv(self, filename, filters=[], histories=[]):
-        (outls, trumped) = self.showlist()
-        (colorls, _) = self.showlist(True, filters, histories)
-        if (len(colorls) >= len(outls)):
-            colorls = ()
-
-        extrastart = [ state for state in self.startstates if not self.states[state].is_maximal ]
-        outls = extrastart + outls
-
-        nodenames = {}
-        pos = 1
-        for state in outls:
-            nodenames[state] = str(pos)
-            pos = pos+1
+        (outls, positions) = self.exportlist(filters, histories)
 
-        fl = open(filename, 'w')
+        fl = open(filename, 'w', buffering=EXPORT_BUFFER)
         fl.write('digraph PlotEx {\n')
         fl.write('\n')
-        for state in outls:
-            node = self.states[state]
+        for (pos, (state, node, colored)) in enumerate(outls):
             penwidth = 1
-            if (node.is_maximal and not node.children):
+            if (node.is_terminal()):
                 penwidth = 3
             color = 'gray75'
-            if (state in colorls):
+            if (colored):
                 color = 'forestgreen'
             if (not node.is_maximal):
                 color = 'white'
-            fl.write('# %s\n' % (state,))
-            fl.write('"%s" [ label="", shape=circle, width=0.2, style=filled, fillcolor=%s, penwidth=%d ];\n' % (nodenames[state], color, penwidth))
-            fl.write('\n')
-            if (node.is_maximal):
-                for (acls, child) in node.children:
-                    label = '\\n'.join([ ac.name for ac in acls ])
-                    fl.write('  "%s" -> "%s" [ label="%s" ];\n' % (nodenames[state], nodenames[child], label))
-            else:
-                acls = node.maxing_actions
+            fl.write('# %s\n"%d" [ label="", shape=circle, width=0.2, style=filled, fillcolor=%s, penwidth=%d ];\n\n' % (state, pos+1, color, penwidth))
+            for (acls, target, improve) in self.exportedges(node, positions):
                 label = '\\n'.join([ ac.name for ac in acls ])
-                fl.write('  "%s" -> "%s" [ label="%s", style=dashed ];\n' % (nodenames[state], nodenames[node.maximal], label))
-            fl.write('\n')
-            fl.write('\n')
+                if (improve):
+                    fl.write('  "%d" -> "%d" [ label="%s", style=dashed ];\n' % (pos+1, target+1, label))
+                else:
+                    fl.write('  "%d" -> "%d" [ label="%s" ];\n' % (pos+1, target+1, label))
+            fl.write('\n\n')
                                                      
         fl.write('}\n')
+        fl.close()
 
     def writegml(self, filename, filters=[], histories=[]):
-        (outls, trumped) = self.showlist()
-        (colorls, _) = self.showlist(True, filters, histories)
-        if (len(colorls) >= len(outls)):
-            colorls = ()
-
-        extrastart = [ state for state in self.startstates if not self.states[state].is_maximal ]
-        outls = extrastart + outls
-
-        nodenames = {}
-        pos = 1
-        for state in outls:
-            nodenames[state] = pos
-            pos = pos+1
+        (outls, positions) = self.exportlist(filters, histories)
 
-        fl = open(filename, 'w')
+        fl = open(filename, 'w', buffering=EXPORT_BUFFER)
         fl.write('graph [\n')
         fl.write('  directed 1\n\n')
-        for state in outls:
-            node = self.states[state]
-            penwidth = 1
-            if (node.is_maximal and not node.children):
-                penwidth = 3
-            color = 'gray75'
-            if (state in colorls):
-                color = 'forestgreen'
-            if (not node.is_maximal):
-                color = 'white'
-            fl.write('  comment "%s"\n' % (state,))
-            fl.write('  node [ id %d ]\n' % (nodenames[state],))
-            fl.write('\n')
-            if (node.is_maximal):
-                for (acls, child) in node.children:
-                    label = ' '.join([ ac.name for ac in acls ])
-                    fl.write('  edge [ source %d target %d label "%s" ]\n' % (nodenames[state], nodenames[child], label))
-            else:
-                acls = node.maxing_actions
+        for (pos, (state, node, colored)) in enumerate(outls):
+            fl.write('  comment "%s"\n  node [ id %d ]\n\n' % (state, pos+1))
+            for (acls, target, improve) in self.exportedges(node, positions):
                 label = ' '.join([ ac.name for ac in acls ])
-                fl.write('  edge [ source %d target %d label "%s" ]\n' % (nodenames[state], nodenames[node.maximal], label))
-            fl.write('\n')
-            fl.write('\n')
+                fl.write('  edge [ source %d target %d label "%s" ]\n' % (pos+1, target+1, label))
+            fl.write('\n\n')
                                                      
         fl.write(']\n')
+        fl.close()
+
+    def writejsonl(self, filename, filters=[], histories=[]):
+        '''Write the graph as JSON Lines: one object per line. There is a
+        "node" object for each state, followed by an "edge" object for
+        each edge out of it. Set values are written as sorted lists.
+        Node ids count from 1, as in the other formats.
+        '''
+        (outls, positions) = self.exportlist(filters, histories)
+
+        def jsonvalue(val):
+            if (isinstance(val, frozenset)):
+                return sorted(val)
+            raise TypeError('cannot export value: %r' % (val,))
+        
+        fl = open(filename, 'w', buffering=EXPORT_BUFFER)
+        for (pos, (state, node, colored)) in enumerate(outls):
+            obj = {
+                'type': 'node', 'id': pos+1, 'state': state.dic,
+                'maximal': node.is_maximal,
+                'terminal': node.is_terminal(),
+                'colored': colored,
+                'history': [ ac.name for ac in self.history(node) ],
+            }
+            fl.write(json.dumps(obj, sort_keys=True, default=jsonvalue))
+            fl.write('\n')
+            for (acls, target, improve) in self.exportedges(node, positions):
+                obj = {
+                    'type': 'edge', 'source': pos+1, 'target': target+1,
+                    'actions': [ ac.name for ac in acls ],
+                    'improve': improve,
+                }
+                fl.write(json.dumps(obj, sort_keys=True))
+                fl.write('\n')
+        fl.close()
+
+    def writenpz(self, filename, filters=[], histories=[]):
+        '''Write the graph as a NumPy .npz archive, with the adjacency in
+        CSR form: the edges out of node i are indices[indptr[i]:indptr[i+1]].
+        Node ids count from 0 here. The arrays are:
+
+            indptr, indices: the adjacency (int32)
+            improve: per edge, whether it's an improve edge
+            labels: per edge, its action names, space-separated
+            maximal, terminal, colored: per node flags
+            states: per node, the state as a string
+        '''
+        if (numpy is None):
+            raise Exception('The --npz option requires numpy')
+        (outls, positions) = self.exportlist(filters, histories)
+
+        indptr = numpy.zeros(len(outls)+1, dtype=numpy.int32)
+        indices = []
+        improves = []
+        labels = []
+        for (pos, (state, node, colored)) in enumerate(outls):
+            for (acls, target, improve) in self.exportedges(node, positions):
+                indices.append(target)
+                improves.append(improve)
+                labels.append(' '.join([ ac.name for ac in acls ]))
+            indptr[pos+1] = len(indices)
+
+        fl = open(filename, 'wb')
+        numpy.savez_compressed(fl,
+            indptr=indptr,
+            indices=numpy.array(indices, dtype=numpy.int32),
+            improve=numpy.array(improves, dtype=bool),
+            labels=numpy.array(labels, dtype=str),
+            maximal=numpy.array([ node.is_maximal for (state, node, colored) in outls ], dtype=bool),
+            terminal=numpy.array([ node.is_terminal() for (state, node, colored) in outls ], dtype=bool),
+            colored=numpy.array([ colored for (state, node, colored) in outls ], dtype=bool),
+            states=numpy.array([ str(state) for (state, node, colored) in outls ], dtype=str))
+        fl.close()
+
 
+class ActionIndex:
+    '''ActionIndex: A precondition index over a bound action list (see
+    Graph.bind). It's built from the compiled form of each action (see
+    compile_action), whether or not the run uses compiled actions.
+
+    For each action, we pick one quality that its guard requires to be
+    present (if there is one); candidates() only offers actions whose
+    quality is in the state. We also note every quality the action reads
+    or writes; touched() tells which actions might behave differently
+    after some qualities change. Actions that can't be compiled (or that
+    Reset the state) are always offered and always touched.
+    '''
+    def __init__(self, scenario, actions):
+        self.actions = actions
+        self.always = []
+        self.witness = {}
+        self.touching = {}
+        self.untracked = set()
+        for (pos, (action, func)) in enumerate(actions):
+            compiled = action.compiled
+            if (compiled is None):
+                compiled = compile_action(action, scenario)
+            if (compiled is None or compiled.reset):
+                self.always.append(pos)
+                self.untracked.add(pos)
+                continue
+            if (compiled.never):
+                continue
+            key = compiled.witness()
+            if (key is None):
+                self.always.append(pos)
+            else:
+                self.witness.setdefault(key, []).append(pos)
+            for key in compiled.reads.union(compiled.writes):
+                self.touching.setdefault(key, set()).add(pos)
+
+    def candidates(self, state):
+        '''Return the positions (in order) of the actions which might
+        apply to this state.
+        '''
+        res = list(self.always)
+        witness = self.witness
+        for key in state.dic:
+            ls = witness.get(key)
+            if (ls):
+                res.extend(ls)
+        res.sort()
+        return res
+
+    def touched(self, oldstate, newstate):
+        '''Return the positions of the actions which read or write any
+        quality that differs between the two states.
+        '''
+        olddic = oldstate.dic
+        newdic = newstate.dic
+        res = set(self.untracked)
+        touching = self.touching
+        for (key, val) in newdic.items():
+            if (olddic.get(key) != val):
+                res.update(touching.get(key, ()))
+        for key in olddic:
+            if (key not in newdic):
+                res.update(touching.get(key, ()))
+        return res
+
+class SleepSets:
+    '''SleepSets: Partial-order reduction for the change actions of a
+    run (a bound list; see Graph.bind).
+
+    Two change actions are independent if doing one can't affect the
+    other -- not directly, and not through the improvements that
+    find_maximal_state() makes afterwards. Then doing A and then B
+    reaches the same maximal state as doing B and then A. So if we've
+    done B from a state, and then do A, there's no need to do B again
+    from the result; B is put to "sleep" there. (The classic sleep set
+    method.) Every maximal state is still reached, but some edges are
+    never built.
+
+    Independence comes from the compiled form of each action (see
+    compile_action). For a change action, we work out every quality
+    that it, or any improve action it might set off, could write (its
+    reach), and every quality those actions look at. Two actions are
+    independent if neither one's reach overlaps what the other looks
+    at. Actions that can't be compiled, or Reset the state, are
+    independent of nothing.
+
+    Sleep sets are int bitmasks over action positions. A maximal state
+    can be reached with different sleep sets; we keep the intersection,
+    and if that wakes an action in a state we've already expanded, the
+    state is expanded again for just that action.
+    '''
+    def __init__(self, scenario, improveactions, changeactions, symmetry=None):
+        keybits = {}
+        def mask(keys):
+            res = 0
+            for key in keys:
+                if (symmetry is not None):
+                    for (group, sense) in symmetry.groups:
+                        if (key in group):
+                            keys = group
+                            break
+                    else:
+                        keys = (key,)
+                else:
+                    keys = (key,)
+                for key in keys:
+                    bit = keybits.get(key)
+                    if (bit is None):
+                        bit = 1 << len(keybits)
+                        keybits[key] = bit
+                    res |= bit
+            return res
+        def compiled(action):
+            res = action.compiled
+            if (res is None):
+                res = compile_action(action, scenario)
+            if (res is None or res.reset):
+                return None
+            return res
+
+        improves = []
+        opaque = False
+        for (action, func) in improveactions:
+            comp = compiled(action)
+            if (comp is None):
+                opaque = True
+            elif (not comp.never):
+                improves.append( (mask(comp.reads | comp.writes), mask(comp.writes)) )
+
+        reach = []
+        looks = []
+        for (action, func) in changeactions:
+            comp = compiled(action)
+            if (comp is None):
+                reach.append(-1)
+                looks.append(-1)
+                continue
+            if (comp.never):
+                reach.append(0)
+                looks.append(0)
+                continue
+            written = mask(comp.writes)
+            looked = mask(comp.reads | comp.writes)
+            if (opaque and written):
+                written = -1
+            triggered = set()
+            while (written != -1):
+                found = False
+                for (pos, (deps, writes)) in enumerate(improves):
+                    if (pos not in triggered and (deps & written)):
+                        triggered.add(pos)
+                        looked |= deps
+                        written |= writes
+                        found = True
+                if (not found):
+                    break
+            reach.append(written)
+            looks.append(looked | written)
+
+        self.indep = []
+        for pos1 in range(len(changeactions)):
+            val = 0
+            for pos2 in range(len(changeactions)):
+                if (pos1 != pos2 and not (reach[pos1] & looks[pos2]) and not (reach[pos2] & looks[pos1])):
+                    val |= (1 << pos2)
+            self.indep.append(val)
+        self.sleep = {}
+        self.expanded = set()
+        self.woken = {}
+
+    def start(self, state):
+        '''Begin expanding a state. Return a mask of the actions to try,
+        and whether this is the first time the state is expanded.
+        '''
+        if (state in self.expanded):
+            return (self.woken.pop(state, 0), False)
+        self.expanded.add(state)
+        self.woken.pop(state, None)
+        return (~self.sleep.get(state, 0), True)
+
+    def visit(self, state, oldstate, pos, done):
+        '''Note that the action at pos leads from oldstate to state, where
+        done is the mask of actions that have already led somewhere from
+        oldstate. Return whether this wakes an action in state, which
+        has already been expanded (so it must be expanded again).
+        '''
+        newsleep = (self.sleep[oldstate] | done) & self.indep[pos]
+        oldsleep = self.sleep.get(state)
+        if (oldsleep is None):
+            self.sleep[state] = newsleep
+            return False
+        woken = oldsleep & ~newsleep
+        if (not woken):
+            return False
+        self.sleep[state] = oldsleep & newsleep
+        if (state not in self.expanded):
+            return False
+        self.woken[state] = self.woken.get(state, 0) | woken
+        return True
+
+class ActionCache:
+    '''ActionCache: A size-bounded memo of action results, keyed by
+    (action, state). When it's full, the least recently used entry is
+    thrown out. It counts hits, misses, and evictions, so that you can
+    tell whether the size is right for your scenario.
+
+    A scenario has at most one of these (in _actioncache); every graph
+    run on the scenario shares it.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.table = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def wrap(self, action, func):
+        '''Return a callable that does func(state) through the cache.
+        '''
+        table = self.table
+        def cached(state):
+            key = (action, state)
+            res = table.get(key, table)
+            if (res is not table):
+                self.hits += 1
+                table.move_to_end(key)
+                return res
+            self.misses += 1
+            res = func(state)
+            table[key] = res
+            if (len(table) > self.size):
+                table.popitem(last=False)
+                self.evictions += 1
+            return res
+        return cached
+
+    def report(self):
+        '''Return a one-line summary of the cache statistics.
+        '''
+        total = self.hits + self.misses
+        rate = 0.0
+        if (total):
+            rate = 100.0 * self.hits / total
+        return '(action cache: %d hits, %d misses, %.1f%% hit rate, %d evictions, %d of %d entries used)' % (self.hits, self.misses, rate, self.evictions, len(self.table), self.size)
+
+class RunProfile:
+    '''RunProfile: Statistics about where a scenario's runs spend their
+    time. For each action (see Graph.actfunc): how often it was called,
+    how often it succeeded, and the time spent in it. For each phase of
+    the work (see PHASES), the time spent. And the biggest graph built,
+    in nodes and edges. Times are in seconds.
+
+    The phases are: improve (finding maximal states, including the
+    action calls that takes); change (the rest of expanding states);
+    hash (working out state hashes, which also counts toward whichever
+    phase it happened in); verify (checking tests against a graph); and
+    display (printing results and writing graph files).
+
+    A scenario has at most one of these (in _profile); every graph run
+    on the scenario adds to it. Work done in worker processes (see -j)
+    isn't counted.
+    '''
+    PHASES = ('improve', 'change', 'hash', 'verify', 'display')
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.successes = collections.Counter()
+        self.times = collections.Counter()
+        self.phases = collections.Counter()
+        self.runs = 0
+        self.peaknodes = 0
+        self.peakedges = 0
+
+    def wrap(self, action, func):
+        '''Return a callable that does func(state), counting and timing
+        it under the action's name.
+        '''
+        name = action.name
+        clock = time.perf_counter
+        def profiled(state):
+            start = clock()
+            res = func(state)
+            self.times[name] += clock() - start
+            self.calls[name] += 1
+            if (res):
+                self.successes[name] += 1
+            return res
+        return profiled
+
+    def timed(self, phase, func):
+        '''Return a callable that does func(...), adding its time to the
+        given phase.
+        '''
+        clock = time.perf_counter
+        def timedfunc(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                self.phases[phase] += clock() - start
+        return timedfunc
+
+    def addtime(self, phase, val):
+        self.phases[phase] += val
+
+    def addgraph(self, graph):
+        '''Note a finished run, and the size of its graph.
+        '''
+        stats = graph.stats()
+        self.runs = self.runs+1
+        self.peaknodes = max(self.peaknodes, stats['nodes'])
+        self.peakedges = max(self.peakedges, stats['edges'])
+
+    def asdict(self):
+        '''Return the statistics as a dict of plain values (suitable for
+        JSON).
+        '''
+        actions = {}
+        for name in self.calls:
+            actions[name] = { 'calls': self.calls[name], 'successes': self.successes[name], 'time': self.times[name] }
+        return {
+            'actions': actions,
+            'phases': dict([ (phase, self.phases[phase]) for phase in self.PHASES ]),
+            'runs': self.runs,
+            'peak_nodes': self.peaknodes,
+            'peak_edges': self.peakedges,
+        }
+
+    def report(self):
+        '''Return the statistics as a table (a list of lines). The actions
+        are listed with the slowest first.
+        '''
+        names = list(self.calls.keys())
+        names.sort(key=lambda name: (-self.times[name], name))
+        width = max([ len(name) for name in names ] + [7])
+        res = []
+        res.append('%-*s %10s %8s %10s' % (width, 'action', 'calls', 'success', 'time'))
+        for name in names:
+            calls = self.calls[name]
+            rate = 100.0 * self.successes[name] / calls
+            res.append('%-*s %10d %7.1f%% %10.4f' % (width, name, calls, rate, self.times[name]))
+        res.append('')
+        res.append('%-*s %10s' % (width, 'phase', 'time'))
+        for phase in self.PHASES:
+            res.append('%-*s %10.4f' % (width, phase, self.phases[phase]))
+        res.append('')
+        res.append('runs: %d; peak graph: %d nodes, %d edges' % (self.runs, self.peaknodes, self.peakedges))
+        return res
+
+class StateTable:
+    '''StateTable: A table of states, so that each distinct state that a
+    run produces exists only once (hash-consing). Two interned states
+    are equal only if they're the same object, so comparing them is an
+    identity check, and each one's hash is worked out just once, when
+    it's interned.
+
+    A scenario has at most one of these (in _statetable); every graph
+    run on the scenario shares it. States come in through the action
+    functions (see Graph.actfunc), the start states, and make_state().
+    '''
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+
+    def intern(self, state):
+        '''Return the table's copy of a state, adding it if it's new.
+        '''
+        if (state.interned):
+            return state
+        res = self.table.get(state)
+        if (res is not None):
+            self.hits += 1
+            return res
+        state.interned = True
+        self.table[state] = state
+        return state
+
+    def wrap(self, func):
+        '''Return a callable that does func(state) and interns the result.
+        '''
+        intern = self.intern
+        def interned(state):
+            res = func(state)
+            if (not res):
+                return res
+            return intern(res)
+        return interned
+
+    def report(self):
+        '''Return a one-line summary of the table statistics.
+        '''
+        return '(state table: %d states, %d duplicates merged)' % (len(self.table), self.hits)
+
+class Frontier:
+    '''Frontier: The set of maximal states waiting to be expanded during
+    a Graph run. States come out in the order they went in (breadth-first);
+    the subclasses pick other orders. Membership tests are O(1).
+    '''
+    def __init__(self):
+        self.queue = collections.deque()
+        self.members = set()
+    def __len__(self):
+        return len(self.members)
+    def __contains__(self, state):
+        return (state in self.members)
+    def push(self, state):
+        self.queue.append(state)
+        self.members.add(state)
+    def pop(self):
+        state = self.queue.popleft()
+        self.members.discard(state)
+        return state
+    def peek(self, count):
+        '''Return (up to) the next count states that pop() would return,
+        without removing them.
+        '''
+        return list(itertools.islice(self.queue, count))
+
+class DepthFirstFrontier(Frontier):
+    '''DepthFirstFrontier: Expand the most recently found state first.
+    '''
+    def pop(self):
+        state = self.queue.pop()
+        self.members.discard(state)
+        return state
+    def peek(self, count):
+        return list(itertools.islice(reversed(self.queue), count))
+
+class PriorityFrontier(Frontier):
+    '''PriorityFrontier: Expand the state with the most qualities first.
+    Ties are broken in order of discovery.
+    '''
+    def __init__(self):
+        self.queue = []
+        self.members = set()
+        self.counter = 0
+    def priority(self, state):
+        return -len(state.dic)
+    def push(self, state):
+        heapq.heappush(self.queue, (self.priority(state), self.counter, state))
+        self.counter = self.counter+1
+        self.members.add(state)
+    def pop(self):
+        (_, _, state) = heapq.heappop(self.queue)
+        self.members.discard(state)
+        return state
+    def peek(self, count):
+        return [ state for (_, _, state) in heapq.nsmallest(count, self.queue) ]
+
+class GoalFrontier(PriorityFrontier):
+    '''GoalFrontier: Expand the state with the best score first, where
+    score is a function from states to numbers. Ties go to the state
+    with the most qualities, and then in order of discovery.
+    '''
+    def __init__(self, score):
+        PriorityFrontier.__init__(self)
+        self.score = score
+    def priority(self, state):
+        return (-self.score(state), -len(state.dic))
+
+FRONTIER_POLICIES = {
+    'bfs': Frontier,
+    'dfs': DepthFirstFrontier,
+    'priority': PriorityFrontier,
+}
 
 class GraphNode:
     '''GraphNode: Context information for a single state in a Graph.
     (We never store information in the State itself -- that's immutable.)
+
+    To keep big runs small, nodes have no __dict__, and their edges are
+    kept in an EdgeTable's packed form (outs and ins, which are None if
+    there are no edges). The children and parents properties give them
+    as lists of (actions, state) pairs; add edges with add_child() and
+    add_parent().
     '''
-    def __init__(self, state):
+    __slots__ = ('state', 'maximal', 'is_maximal', 'maxing_actions',
+                 'history', 'index', 'ancestry', 'slept',
+                 'edgetable', 'outs', 'ins')
+    
+    def __init__(self, state, edgetable):
         self.state = state
         self.maximal = None
         self.is_maximal = False
-        self.children = []
-        self.parents = []
+        self.maxing_actions = ()
         self.history = ()
-        self.ancestors = set()
+        self.index = None
+        self.ancestry = 0
+        self.slept = False
+        self.edgetable = edgetable
+        self.outs = None
+        self.ins = None
+
+    def get_children(self):
+        return self.edgetable.decode(self.outs)
+    def set_children(self, edges):
+        self.outs = self.edgetable.encode(edges)
+    children = property(get_children, set_children)
+
+    def get_parents(self):
+        return self.edgetable.decode(self.ins)
+    def set_parents(self, edges):
+        self.ins = self.edgetable.encode(edges)
+    parents = property(get_parents, set_parents)
+
+    def add_child(self, aclist, state):
+        self.outs = self.edgetable.add(self.outs, aclist, state)
+    def add_parent(self, aclist, state):
+        self.ins = self.edgetable.add(self.ins, aclist, state)
+
+    def is_terminal(self):
+        '''Return whether this is a terminal state: a maximal state with
+        nowhere to go. (A run with SleepSets may skip edges out of a
+        state; then slept is set, and the state isn't terminal.)
+        '''
+        return (self.is_maximal and not self.outs and not self.slept)
+
+class EdgeTable:
+    '''EdgeTable: The shared storage for a Graph's edges. Edges only
+    run between maximal states, so an edge can be stored as two ints:
+    the position of its action tuple in the aclists list, and the node
+    index of the state at the other end. A node's edges are a flat
+    array of these pairs.
+
+    The states list is the Graph's idstates: every maximal state, in
+    node index order. Add to it with addstate().
+    '''
+    def __init__(self):
+        self.states = []
+        self.positions = {}
+        self.aclists = []
+        self.acpos = {}
+
+    def addstate(self, state):
+        '''Add a maximal state, and return its node index.
+        '''
+        pos = len(self.states)
+        self.states.append(state)
+        self.positions[state] = pos
+        return pos
+
+    def add(self, arr, aclist, state):
+        '''Append an edge to an array (which may be None). Return the
+        array.
+        '''
+        acpos = self.acpos.get(aclist)
+        if (acpos is None):
+            acpos = len(self.aclists)
+            self.aclists.append(aclist)
+            self.acpos[aclist] = acpos
+        if (arr is None):
+            arr = array.array('i')
+        arr.append(acpos)
+        arr.append(self.positions[state])
+        return arr
+
+    def encode(self, edges):
+        arr = None
+        for (aclist, state) in edges:
+            arr = self.add(arr, aclist, state)
+        return arr
+
+    def decode(self, arr):
+        if (not arr):
+            return []
+        aclists = self.aclists
+        states = self.states
+        return [ (aclists[arr[pos]], states[arr[pos+1]]) for pos in range(0, len(arr), 2) ]
             
+def pack_node(node, stateref):
+    '''Pack a GraphNode as a tuple of plain values, with actions stored
+    by name and states by stateref(state). (Graph.save() refers to states
+    by position; a SpillStore refers to them by dict.) The inverse is
+    unpack_node().
+    '''
+    def names(acls):
+        return tuple([ ac.name for ac in acls ])
+    children = [ (names(acls), stateref(child)) for (acls, child) in node.children ]
+    parents = [ (names(acls), stateref(parent)) for (acls, parent) in node.parents ]
+    return (stateref(node.maximal), node.is_maximal,
+            names(node.maxing_actions), names(node.history),
+            node.index, node.ancestry, children, parents, node.slept)
+
+def unpack_node(state, val, acts, stateof, edgetable):
+    '''Rebuild a GraphNode from the tuple made by pack_node(). The acts
+    function turns a tuple of names into a tuple of actions; stateof
+    turns a stored reference back into a state. The states at the ends
+    of the node's edges must already be in the edgetable.
+    '''
+    node = GraphNode(state, edgetable)
+    (maxref, node.is_maximal, maxing, history, node.index, node.ancestry, children, parents, node.slept) = val
+    node.maximal = stateof(maxref)
+    node.maxing_actions = acts(maxing)
+    node.history = acts(history)
+    node.children = [ (acts(names), stateof(ref)) for (names, ref) in children ]
+    node.parents = [ (acts(names), stateof(ref)) for (names, ref) in parents ]
+    return node
+
+class SpillStore:
+    '''SpillStore: A stand-in for the Graph's dict of GraphNodes, for runs
+    which are too big to keep in memory. Up to budget nodes are held in
+    memory. Beyond that, when trim() is called, the least recently used
+    nodes are written out to a temporary sqlite database, and read back
+    when they're wanted again. Nodes are stored with pack_node(), so a
+    node which comes back is a copy.
+
+    Because of that, trim() must only be called when nobody is holding
+    on to a node (see Graph.expand_all). Between calls, the store holds
+    every node that was touched, even if that goes over budget.
+
+    Every state gets a position when it's added, in order; the statels
+    attribute is a SpillList which looks up states by position.
+
+    Only the nodes are spilled. The Graph's other bookkeeping (the list
+    of maximal states, seenmaxes, the EdgeTable's positions, and the
+    frontier) stays in memory, and grows with the run.
+    '''
+    def __init__(self, scenario, actions, budget, edgetable):
+        self.scenario = scenario
+        self.budget = max(budget, 1)
+        self.edgetable = edgetable
+        self.actionmap = {}
+        for action in actions:
+            self.actionmap[action.name] = action
+        self.hot = collections.OrderedDict()
+        self.hotpos = {}
+        self.hotstates = {}
+        self.count = 0
+        self.db = sqlite3.connect('')
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE nodes (pos INTEGER PRIMARY KEY, hash INTEGER, state BLOB, node BLOB)')
+        self.db.execute('CREATE INDEX nodes_hash ON nodes (hash)')
+        self.statels = SpillList(self)
+
+    def __len__(self):
+        return self.count
+    def __contains__(self, state):
+        return (self.get(state) is not None)
+    def __getitem__(self, state):
+        node = self.get(state)
+        if (node is None):
+            raise KeyError(state)
+        return node
+    def __setitem__(self, state, node):
+        # The Graph only adds a state after checking that it isn't here.
+        if (state not in self.hotpos):
+            self.hotpos[state] = self.count
+            self.hotstates[self.count] = state
+            self.count = self.count+1
+        self.hot[state] = node
+        self.hot.move_to_end(state)
+
+    def get(self, state, default=None):
+        node = self.hot.get(state)
+        if (node is not None):
+            self.hot.move_to_end(state)
+            return node
+        rows = self.db.execute('SELECT pos, state, node FROM nodes WHERE hash = ?', (hash(state),))
+        for (pos, dic, val) in rows.fetchall():
+            if (self.stateof(pickle.loads(dic)) != state):
+                continue
+            node = unpack_node(state, pickle.loads(val), self.acts, self.stateof, self.edgetable)
+            self.hot[state] = node
+            self.hotpos[state] = pos
+            self.hotstates[pos] = state
+            return node
+        return default
+
+    def keys(self):
+        return iter(self.statels)
+
+    def acts(self, names):
+        return tuple([ self.actionmap[name] for name in names ])
+    def stateof(self, dic):
+        if (dic is None):
+            return None
+        return make_state(self.scenario, dic)
+    def dicof(self, state):
+        if (state is None):
+            return None
+        return state.dic
+
+    def write(self, states):
+        rows = []
+        for state in states:
+            val = pack_node(self.hot[state], self.dicof)
+            rows.append( (self.hotpos[state], hash(state),
+                          pickle.dumps(state.dic, pickle.HIGHEST_PROTOCOL),
+                          pickle.dumps(val, pickle.HIGHEST_PROTOCOL)) )
+        self.db.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)', rows)
+
+    def trim(self):
+        '''If more than budget nodes are in memory, write out the least
+        recently used ones, leaving half the budget.
+        '''
+        if (len(self.hot) <= self.budget):
+            return
+        states = list(itertools.islice(self.hot.keys(), len(self.hot) - self.budget//2))
+        self.write(states)
+        for state in states:
+            del self.hot[state]
+            del self.hotstates[self.hotpos.pop(state)]
+
+    def spilled(self):
+        '''Return the number of nodes in the database.
+        '''
+        (count,) = self.db.execute('SELECT COUNT(*) FROM nodes').fetchone()
+        return count
+
+class SpillList:
+    '''SpillList: The list of every state in a SpillStore, in the order
+    they were added. States that are only on disk come back as copies.
+    '''
+    def __init__(self, store):
+        self.store = store
+    def __len__(self):
+        return self.store.count
+    def __getitem__(self, pos):
+        state = self.store.hotstates.get(pos)
+        if (state is not None):
+            return state
+        row = self.store.db.execute('SELECT state FROM nodes WHERE pos = ?', (pos,)).fetchone()
+        if (row is None):
+            raise IndexError(pos)
+        return self.store.stateof(pickle.loads(row[0]))
+    def __iter__(self):
+        for pos in range(self.store.count):
+            yield self[pos]
+    def append(self, state):
+        # The store gave the state its position when it was added.
+        pass
+
 class State:
     '''State: One state in the plot diagram. A state is set up with a
     bunch of qualities.
@@ -501,19 +1720,25 @@ class State:
     algorithm. (It skips some of the type-checking and state-fixing,
     on the assumption that the caller has done some of that work
     already.)
+
+    A big run makes a great many states, so they have no __dict__.
+    (The interned flag is set by a StateTable.)
     '''
-    name = None
-    scenario = None
+    __slots__ = ('name', 'scenario', 'dic', 'typelist', 'hashcache', 'codecache', 'interned')
     
     def __init__(self, __dic=None, __newkeys=None, **kargs):
         if (__dic is None):
             __dic = kargs
+        self.name = None
+        self.interned = False
         if (global_scenario is None):
             self.typelist = infer_typelist(__dic)
+            self.scenario = None
         else:
             self.typelist = None
             self.scenario = global_scenario
         self.hashcache = None
+        self.codecache = None
         if (not __dic):
             self.dic = {}
             return
@@ -594,9 +1819,16 @@ class State:
             return '<%s>' % (joined,)
 
     def __eq__(self, other):
+        if (self is other):
+            return True
+        if (self.interned and other.interned):
+            return False
+        scen = self.scenario
+        if (scen is not None and scen._codec is not None):
+            return (self.encode() == other.encode())
         return (self.dic == other.dic)
     def __ne__(self, other):
-        return (self.dic != other.dic)
+        return not self.__eq__(other)
     def __gt__(self, other):
         return (self != other) and self.contains(other)
     def __ge__(self, other):
@@ -607,6 +1839,11 @@ class State:
         return other.contains(self)
 
     def __and__(self, other):
+        codec = self.scenario._codec
+        if (codec is not None):
+            res = State(codec.decode(codec.meet(self.encode(), other.encode())))
+            res.scenario = self.scenario
+            return res
         dic = {}
         keyset = set(self.dic.keys()).union(list(other.dic.keys()))
         for key in keyset:
@@ -648,12 +1885,34 @@ class State:
 
     def __hash__(self):
         if (self.hashcache is None):
-            ls = list(self.dic.items())
-            ls.sort()
-            self.hashcache = hash(tuple(ls))
+            scen = self.scenario
+            if (scen is not None and scen._profile is not None):
+                start = time.perf_counter()
+                self.hashcache = self.compute_hash()
+                scen._profile.addtime('hash', time.perf_counter() - start)
+            else:
+                self.hashcache = self.compute_hash()
         return self.hashcache
 
-    def canonize(dic, changedkeys=None):
+    def compute_hash(self):
+        scen = self.scenario
+        if (scen is not None and scen._zobrist is not None):
+            return scen._zobrist.hash(self.dic)
+        if (scen is not None and scen._codec is not None):
+            return hash(self.encode())
+        ls = list(self.dic.items())
+        ls.sort()
+        return hash(tuple(ls))
+
+    def encode(self):
+        '''Return the compact (bits, slots) form of this state. This is
+        only available when the scenario has a StateCodec.
+        '''
+        if (self.codecache is None):
+            self.codecache = self.scenario._codec.encode(self.dic)
+        return self.codecache
+
+    def canonize(dic, changedkeys=None):
         '''Modify a dictionary to be a legal state dict (no false values,
         sets values in frozenset form).
         '''
@@ -671,6 +1930,7 @@ class State:
         res = State()
         res.scenario = self.scenario
         res.dic = dict(self.dic)
+        res.codecache = self.codecache
         return res
 
     def addquality(self, key, val):
@@ -696,6 +1956,9 @@ class State:
         '''X.contains(Y) is the basic comparison -- X is a subset of (or
         equal to) Y.
         '''
+        codec = self.scenario._codec
+        if (codec is not None):
+            return codec.contains(self.encode(), other.encode())
         for (key, oval) in list(other.dic.items()):
             if (not self.scenario._sensemap[key]):
                 continue
@@ -753,6 +2016,528 @@ class State:
                 return False
         return True
 
+class StateCodec:
+    '''StateCodec: A compact encoding of the states of one scenario.
+    Boolean qualities and set members become bit positions in a single
+    int; int and str qualities become slots in a tuple. A state's code
+    is the pair (bits, slots), and two states are equal exactly when
+    their codes are equal.
+
+    The code doesn't replace the state's dict; it's worked out once per
+    state (see State.encode) and kept alongside it, as a faster key for
+    comparing and hashing.
+
+    This only works because the quality universe of a scenario is closed
+    once TrackMetaClass has run. (Set members are the exception -- we
+    don't know them all in advance -- so their bits are handed out as
+    they turn up.)
+    '''
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.bitmap = {}
+        self.bitkeys = []
+        self.posmask = 0
+        self.negmask = 0
+        self.slotmap = {}
+        self.slotkeys = []
+        self.slotinfo = []
+        keyls = [ key for key in scenario._typemap if key is not None ]
+        keyls.sort()
+        for key in keyls:
+            typ = scenario._typemap[key]
+            if (typ is bool):
+                self.bit(key, key)
+            elif (typ in (int, str)):
+                self.slotmap[key] = len(self.slotkeys)
+                self.slotinfo.append( (len(self.slotkeys), typ, scenario._sensemap[key]) )
+                self.slotkeys.append(key)
+
+    def bit(self, key, qual):
+        '''Return the bit for a boolean quality (key is the quality name)
+        or a set member (key is a (quality, member) tuple), allocating
+        it if necessary.
+        '''
+        val = self.bitmap.get(key)
+        if (val is None):
+            val = 1 << len(self.bitkeys)
+            self.bitmap[key] = val
+            self.bitkeys.append(key)
+            if (self.scenario._sensemap[qual]):
+                self.posmask |= val
+            else:
+                self.negmask |= val
+        return val
+
+    def encode(self, dic):
+        '''Return the (bits, slots) code for a (canonized) state dict.
+        '''
+        bits = 0
+        slots = [ None ] * len(self.slotkeys)
+        typemap = self.scenario._typemap
+        for (key, val) in dic.items():
+            typ = typemap[key]
+            if (typ is bool):
+                bits |= self.bitmap[key]
+            elif (typ is set):
+                for subval in val:
+                    bits |= self.bit((key, subval), key)
+            else:
+                slots[self.slotmap[key]] = val
+        return (bits, tuple(slots))
+
+    def decode(self, code):
+        '''Turn a code back into a state dict.
+        '''
+        (bits, slots) = code
+        dic = {}
+        pos = 0
+        while (bits):
+            if (bits & 1):
+                key = self.bitkeys[pos]
+                if (type(key) is tuple):
+                    (key, subval) = key
+                    dic[key] = dic.get(key, frozenset()).union([subval])
+                else:
+                    dic[key] = True
+            bits >>= 1
+            pos = pos+1
+        for (pos, val) in enumerate(slots):
+            if (val is not None):
+                dic[self.slotkeys[pos]] = val
+        return dic
+
+    def contains(self, code, other):
+        '''The equivalent of State.contains(), on codes.
+        '''
+        (bits, slots) = code
+        (obits, oslots) = other
+        if (obits & self.posmask & ~bits):
+            return False
+        if (bits & self.negmask & ~obits):
+            return False
+        for (pos, typ, sense) in self.slotinfo:
+            val = slots[pos]
+            oval = oslots[pos]
+            if (not sense):
+                (val, oval) = (oval, val)
+            if (oval is None):
+                continue
+            if (val is None):
+                return False
+            if (typ is int):
+                if (val < oval):
+                    return False
+            elif (val != oval):
+                return False
+        return True
+
+    def meet(self, code, other):
+        '''The equivalent of State.__and__(), on codes.
+        '''
+        (bits, slots) = code
+        (obits, oslots) = other
+        resbits = (bits & obits & self.posmask) | ((bits | obits) & self.negmask)
+        resslots = list(slots)
+        for (pos, typ, sense) in self.slotinfo:
+            val = slots[pos]
+            oval = oslots[pos]
+            if (sense):
+                if ((val is None) or (oval is None)):
+                    val = None
+                elif (typ is int):
+                    val = min(val, oval)
+                elif (val != oval):
+                    val = None
+            else:
+                if (val is None):
+                    val = oval
+                elif (oval is None):
+                    pass
+                elif (typ is int):
+                    val = max(val, oval)
+                elif (val != oval):
+                    val = None
+            resslots[pos] = val
+        return (resbits, tuple(resslots))
+
+class ZobristKeys:
+    '''ZobristKeys: Incremental state hashing for one scenario. Each
+    (quality, value) pair gets a random 63-bit key, and a state's hash
+    is the XOR of the keys of its qualities. That needs no sorting, and
+    when an action changes a few qualities, the new state's hash is the
+    old one with just those keys swapped out (see update()). Compiled
+    actions do that; other new states are hashed in full.
+
+    Keys are handed out as pairs turn up, so hashes are only meaningful
+    within one process.
+    '''
+    def __init__(self):
+        self.random = random.Random(0)
+        self.keys = {}
+
+    def item(self, key, val):
+        '''Return the key for one quality. A missing quality (val is
+        None) contributes nothing.
+        '''
+        if (val is None):
+            return 0
+        pair = (key, val)
+        res = self.keys.get(pair)
+        if (res is None):
+            res = self.random.getrandbits(63)
+            self.keys[pair] = res
+        return res
+
+    def hash(self, dic):
+        res = 0
+        for (key, val) in dic.items():
+            res ^= self.item(key, val)
+        return res
+
+    def update(self, hashval, olddic, newdic, keys):
+        '''Given the hash of olddic, return the hash of newdic, which
+        differs from it at most in the given keys.
+        '''
+        for key in keys:
+            oldval = olddic.get(key)
+            newval = newdic.get(key)
+            if (oldval != newval):
+                hashval ^= self.item(key, oldval) ^ self.item(key, newval)
+        return hashval
+
+class DominanceIndex:
+    '''DominanceIndex: A collection of states which can quickly answer
+    the question "is any of these states better than (greater than) this
+    one?"
+
+    Each state gets a score: roughly, how many positive-sense qualities
+    it has, minus how many negative-sense ones. (Set members and int
+    values count individually.) If X < Y then score(X) <= score(Y), so a
+    state only has to be compared against the states with a score at
+    least as high as its own. Those are kept in buckets by score. We
+    also note which positive- and negative-sense qualities each state
+    has; if Y lacks a positive quality that X has (or has a negative one
+    that X lacks), then X < Y is impossible, and we can skip the full
+    comparison.
+    '''
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.keybits = {}
+        self.buckets = {}
+        self.scores = []
+        self.count = 0
+
+    def describe(self, state):
+        '''Return (score, posmask, negmask) for a state.
+        '''
+        score = 0
+        posmask = 0
+        negmask = 0
+        typemap = self.scenario._typemap
+        sensemap = self.scenario._sensemap
+        for (key, val) in state.dic.items():
+            bit = self.keybits.get(key)
+            if (bit is None):
+                bit = 1 << len(self.keybits)
+                self.keybits[key] = bit
+            typ = typemap[key]
+            if (typ is set):
+                val = len(val)
+            elif (typ is int):
+                val = max(val, 0)
+            else:
+                val = 1
+            if (sensemap[key]):
+                score = score + val
+                posmask |= bit
+            else:
+                score = score - val
+                negmask |= bit
+        return (score, posmask, negmask)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, state):
+        '''Add a state to the index.
+        '''
+        (score, posmask, negmask) = self.describe(state)
+        bucket = self.buckets.get(score)
+        if (bucket is None):
+            bucket = []
+            self.buckets[score] = bucket
+            bisect.insort(self.scores, score)
+        bucket.append( (posmask, negmask, state) )
+        self.count = self.count+1
+
+    def remove_below(self, state):
+        '''Remove (and return) the states in the index which are less
+        than this one and have the same score. (Those are the only ones
+        that can be less than a state which isn't itself dominated, if
+        states are added in decreasing order of score.)
+        '''
+        (score, posmask, negmask) = self.describe(state)
+        bucket = self.buckets.get(score)
+        if (not bucket):
+            return []
+        keep = []
+        removed = []
+        for entry in bucket:
+            (oposmask, onegmask, other) = entry
+            if ((oposmask & ~posmask) or (negmask & ~onegmask) or not (other < state)):
+                keep.append(entry)
+            else:
+                removed.append(other)
+        self.buckets[score] = keep
+        self.count = self.count - len(removed)
+        return removed
+
+    def dominated(self, state):
+        '''Return whether some state in the index is greater than this
+        one.
+        '''
+        (score, posmask, negmask) = self.describe(state)
+        pos = bisect.bisect_left(self.scores, score)
+        for oscore in self.scores[pos:]:
+            for (oposmask, onegmask, other) in self.buckets[oscore]:
+                if (posmask & ~oposmask):
+                    continue
+                if (onegmask & ~negmask):
+                    continue
+                if (state < other):
+                    return True
+        return False
+
+def find_trumped(scenario, states):
+    '''Given a list of distinct states, return the set of those which are
+    less than some other state in the list. (The rest are the preferred
+    states.)
+
+    We go through the states in decreasing order of score (see
+    DominanceIndex), keeping an index of the undominated ones so far. A
+    state is trumped if something in the index beats it. (Anything that
+    beats it is either in the index, or beaten by something that is.)
+    '''
+    index = DominanceIndex(scenario)
+    ls = [ (index.describe(state)[0], pos, state) for (pos, state) in enumerate(states) ]
+    ls.sort(key=lambda tup: (-tup[0], tup[1]))
+    trumped = set()
+    for (score, pos, state) in ls:
+        if (index.dominated(state)):
+            trumped.add(state)
+            continue
+        # An earlier state with the same score might be less than this one.
+        trumped.update(index.remove_below(state))
+        index.add(state)
+    return trumped
+
+class Symmetry:
+    '''Symmetry: Groups of interchangeable qualities. A group is a tuple
+    of bool (or int) qualities which the scenario's actions treat alike:
+    swapping any two of them, throughout every action, gives back the
+    same set of actions. (Five identical keys, for example.) Then two
+    states which differ only by such a swap lead to the same places, and
+    only one of them needs to be explored.
+
+    canonical() picks that one: within each group, it sorts the values
+    from best to worst, so the best values go to the first keys (in
+    alphabetical order). Sorting keeps the order between states -- if
+    X < Y, then canonical(X) <= canonical(Y) -- so improvements are
+    still improvements.
+
+    The groups may be declared (the scenario's symmetry attribute), or
+    detected from the actions (see find_symmetry), or both. Detection
+    depends on which actions are in play, and a run must leave out the
+    qualities its tests or filters look at, so forrun() works out the
+    groups for each run.
+    '''
+    def __init__(self, scenario, groups, detect=False):
+        self.scenario = scenario
+        self.detect = detect
+        self.groups = []
+        self.runs = {}
+        seen = set()
+        for group in groups:
+            group = tuple(sorted(group))
+            if (len(group) < 2):
+                raise Exception('Symmetry group %s needs at least two qualities' % (', '.join(group),))
+            for key in group:
+                if (key not in scenario._typemap):
+                    raise Exception('Symmetry group %s: %s is not a quality' % (', '.join(group), key))
+                if (key in seen):
+                    raise Exception('Symmetry group %s: %s is in two groups' % (', '.join(group), key))
+                seen.add(key)
+            typ = scenario._typemap[group[0]]
+            sense = scenario._sensemap[group[0]]
+            if (typ not in (bool, int)):
+                raise Exception('Symmetry group %s: only bool and int qualities can be symmetric' % (', '.join(group),))
+            for key in group:
+                if (scenario._typemap[key] is not typ or scenario._sensemap[key] != sense):
+                    raise Exception('Symmetry group %s: qualities must have the same type and sense' % (', '.join(group),))
+            self.groups.append( (group, sense) )
+        self.groups.sort()
+
+    def forrun(self, actions, fixed=()):
+        '''Return the Symmetry to use for a run with these actions: this
+        one, unless we're detecting groups, in which case the declared
+        groups are merged with the detected ones. The qualities in fixed
+        are taken out of the groups. Return None if there are no groups.
+        '''
+        fixed = frozenset(fixed)
+        if (not self.detect and not [ group for (group, sense) in self.groups if fixed.intersection(group) ]):
+            if (not self.groups):
+                return None
+            return self
+        key = (frozenset([ action.name for action in actions ]), fixed)
+        if (key not in self.runs):
+            groups = [ group for (group, sense) in self.groups ]
+            if (self.detect):
+                groups = merge_groups(groups + find_symmetry(self.scenario, actions))
+            # Taking keys out of a group leaves the rest interchangeable.
+            groups = [ [ key for key in group if key not in fixed ] for group in groups ]
+            groups = [ group for group in groups if len(group) >= 2 ]
+            res = None
+            if (groups):
+                res = Symmetry(self.scenario, groups)
+            self.runs[key] = res
+        return self.runs[key]
+
+    def canonical(self, state):
+        '''Return the canonical form of a state. (This is the same state,
+        if it's already canonical.)
+        '''
+        dic = state.dic
+        newdic = None
+        for (group, sense) in self.groups:
+            vals = [ dic.get(key) for key in group ]
+            if (sense):
+                ls = sorted(vals, key=lambda val: (val is not None, val or 0), reverse=True)
+            else:
+                ls = sorted(vals, key=lambda val: (val is None, -(val or 0)), reverse=True)
+            if (ls == vals):
+                continue
+            if (newdic is None):
+                newdic = dict(dic)
+            for (key, val) in zip(group, ls):
+                if (val is None):
+                    newdic.pop(key, None)
+                else:
+                    newdic[key] = val
+        if (newdic is None):
+            return state
+        return make_state(self.scenario, newdic)
+
+    def replay(self, startstates, history, actions):
+        '''Given a history recorded in a run with this Symmetry, return a
+        list of actions which really lead, one after another, from one
+        of the (canonical) start states to a state equivalent to the
+        end. In the run, each step was taken from the canonical form of
+        the state before it; here each step is that action if it still
+        fits, or else one of the actions it stands in for. If the
+        history can't be replayed, it's returned as it is.
+        '''
+        for start in startstates:
+            state = start
+            res = []
+            for action in history:
+                target = action(self.canonical(state))
+                if (not target):
+                    break
+                target = self.canonical(target)
+                for candidate in [action] + list(actions):
+                    newstate = candidate(state)
+                    if (newstate and self.canonical(newstate) == target):
+                        break
+                else:
+                    break
+                res.append(candidate)
+                state = newstate
+            else:
+                return res
+        return history
+
+    def wrap(self, func):
+        '''Return a callable which does func, and puts the result in
+        canonical form.
+        '''
+        canonical = self.canonical
+        def canonfunc(state):
+            newstate = func(state)
+            if (not newstate):
+                return newstate
+            return canonical(newstate)
+        return canonfunc
+
+def merge_groups(groups):
+    '''Merge a list of groups (tuples of keys) wherever they overlap.
+    Return a sorted list of sorted tuples.
+    '''
+    parent = {}
+    def find(key):
+        while (parent.setdefault(key, key) != key):
+            key = parent[key]
+        return key
+    for group in groups:
+        for key in group[1:]:
+            parent[find(key)] = find(group[0])
+    res = {}
+    for key in parent:
+        res.setdefault(find(key), []).append(key)
+    ls = [ tuple(sorted(group)) for group in res.values() if len(group) >= 2 ]
+    ls.sort()
+    return ls
+
+def find_symmetry(scenario, actions):
+    '''Look for groups of interchangeable qualities in a list of actions.
+    Two qualities a and b (of the same type and sense) are
+    interchangeable if renaming a to b and b to a, in every action's
+    action_signature(), gives back the same collection of signatures.
+    (Only the actions which mention a or b can change.) Return the
+    groups, as for merge_groups().
+
+    Qualities which no action mentions are left alone, as are
+    qualities which turn up in the source of an action class defined
+    outside PlotEx (we can't rename those).
+    '''
+    sigtexts = [ repr(action_signature(action)) for action in actions ]
+    sources = []
+    stack = list(actions)
+    while (stack):
+        action = stack.pop()
+        cla = type(action)
+        if (cla.__module__ != __name__):
+            try:
+                sources.append(inspect.getsource(cla))
+            except (OSError, TypeError):
+                return []
+        stack.extend(action.subactions() or ())
+    classes = {}
+    mentions = {}
+    keyls = [ key for key in scenario._typemap if key is not None ]
+    keyls.sort()
+    for key in keyls:
+        typ = scenario._typemap[key]
+        if (typ not in (bool, int)):
+            continue
+        if ([ source for source in sources if key in source ]):
+            continue
+        text = repr(key)
+        ls = [ pos for (pos, sigtext) in enumerate(sigtexts) if text in sigtext ]
+        if (not ls):
+            continue
+        mentions[key] = ls
+        classes.setdefault( (typ.__name__, scenario._sensemap[key], len(ls)), [] ).append(key)
+    pairs = []
+    for keys in classes.values():
+        for (key1, key2) in itertools.combinations(keys, 2):
+            affected = sorted(set(mentions[key1] + mentions[key2]))
+            rename = { key1: key2, key2: key1 }
+            before = collections.Counter([ sigtexts[pos] for pos in affected ])
+            after = collections.Counter([ repr(action_signature(actions[pos], rename)) for pos in affected ])
+            if (before == after):
+                pairs.append( (key1, key2) )
+    return merge_groups(pairs)
+
 class Test:
     name = '???'
     scenario = None
@@ -842,6 +2627,16 @@ class Test:
             state.scenario = scen
         for ac in self.canactions + self.cannotactions:
             ac.set_scenario(scen)
+        # Name the test's own (unnamed) actions after it, so that they
+        # can be told apart in a RunProfile.
+        for (kind, ls) in (('can', self.canactions), ('cannot', self.cannotactions)):
+            for (pos, ac) in enumerate(ls):
+                if (ac.name != '???'):
+                    continue
+                if (len(ls) == 1):
+                    ac.name = '%s.%s' % (self.name, kind)
+                else:
+                    ac.name = '%s.%s%d' % (self.name, kind, pos+1)
          
     def startstates(self):
         if (not self.startstatelist):
@@ -853,26 +2648,94 @@ class Test:
         actions = [ action for action in list(self.scenario._actionmap.values()) if action not in self.blockactions ]
         return actions
          
-    def verify(self, graph):
-        states = list(graph.states.keys())
+    def runkey(self):
+        '''Return a key describing the run that this test needs: its start
+        states and blocked actions. Tests with the same key can be verified
+        against the same graph.
+        '''
+        return (frozenset(self.startstates()), frozenset(self.blockactions))
+
+    def explore(self, **runopts):
+        '''Do a run with this test's start states and actions. Return the
+        graph. Any keyword arguments are passed along to Graph.run().
+        '''
+        actions = self.actions()
+        actions.sort(key=lambda ac:ac.name)
+        graph = Graph(self.scenario, self.startstates())
+        graph.run(actions, **runopts)
+        return graph
+
+    def check(self, **runopts):
+        '''Do a run with this test's start states and actions, and verify
+        the result. Return whether the test passed.
+        '''
+        graph = self.explore(**runopts)
+        return self.verify(graph)
+         
+    def qualities(self):
+        '''Return the set of qualities this test looks at (gets, getsnot,
+        can, cannot), or None if it looks at histories (includes,
+        excludes). (See fixed_qualities.)
+        '''
+        if (self.includeactions or self.excludeactions):
+            return None
+        res = set(self.getqualities + self.getnotqualities)
+        res.update(merge_typelists_of(self.canactions + self.cannotactions).keys())
+        return res
+
+    def is_positive(self):
+        '''Return whether this test only asks for a state with certain
+        properties (gets, can, includes). Finding one such state is
+        enough to pass it. (The other kinds of test need the whole graph.)
+        '''
+        return not (self.getnotqualities or self.cannotactions or self.excludeactions)
+
+    def allows_pruning(self):
+        '''Return whether this test can be checked against a run which
+        prunes dominated states: it only asks for a state with certain
+        qualities (gets, can). A pruned state's successors are still
+        matched by something at least as good, but its histories, and
+        the states a cannot or getsnot test must rule out, are lost.
+        '''
+        return (self.is_positive() and not self.includeactions)
+
+    def canfuncs(self, graph):
+        '''Return the functions for this test's can actions in the graph
+        (see Graph.actfunc). Build them once and pass them to satisfies()
+        when checking many states.
+        '''
+        return [ graph.actfunc(ac) for ac in self.canactions ]
+
+    def satisfies(self, graph, state, canfuncs=None):
+        '''Return whether a state in the graph has the properties this
+        test asks for (gets, can, includes). The canfuncs argument, if
+        given, is the result of canfuncs(graph).
+        '''
         for qual in self.getqualities:
-            states = [ state for state in states if qual in state.dic ]
-            if (not states):
+            if (qual not in state.dic):
                 return False
-        for ac in self.canactions:
-            states = [ state for state in states if ac(state) ]
-            if (not states):
+        if (canfuncs is None):
+            canfuncs = self.canfuncs(graph)
+        for func in canfuncs:
+            if (not func(state)):
                 return False
         for ac in self.includeactions:
-            states = [ state for state in states if (ac in graph.states[state].history) ]
-            if (not states):
+            if (ac not in graph.states[state].history):
                 return False
+        return True
+
+    def verify(self, graph):
+        canfuncs = self.canfuncs(graph)
+        states = [ state for state in graph.states.keys() if self.satisfies(graph, state, canfuncs) ]
+        if (not states and (self.getqualities or self.canactions or self.includeactions)):
+            return False
         for qual in self.getnotqualities:
             ls = [ state for state in states if qual in state.dic ]
             if (ls):
                 return False
         for ac in self.cannotactions:
-            ls = [ state for state in states if ac(state) ]
+            func = graph.actfunc(ac)
+            ls = [ state for state in states if func(state) ]
             if (ls):
                 return False
         for ac in self.excludeactions:
@@ -898,6 +2761,7 @@ class Action:
     name = '???'
     scenario = None
     equivtype = EQUIV_UNKNOWN
+    compiled = None
     unnamedcount = 0
     def __repr__(self):
         return '<Action "%s">' % (self.name,)
@@ -1166,11 +3030,1343 @@ class Choice(Action):
                 return newstate
         return
 
+# The action classes which compile_action() knows how to reduce.
+ACTION_CLASSES = (Has, HasAny, Set, Reset, Lose, Once, Increment, Decrement,
+                  Include, Exclude, Count, HasDifferent, Chain)
+
+# Compiling actions.
+#
+# An action tree (a Chain of Has, Set, Lose, Once...) can usually be
+# reduced to a single guard (a list of conditions on the old state) and a
+# single effect (a list of changes to it). The guard is a list of clauses,
+# all of which must hold; a clause is a tuple of atoms, any of which must
+# hold. An atom is a tuple (op, key, arg):
+#
+#   ('has', key, None)   -- the key is present
+#   ('not', key, None)   -- the key is absent
+#   ('ge', key, num)     -- int: present and at least num
+#   ('le', key, num)     -- int: absent or at most num
+#   ('eq', key, val)     -- str: present and equal to val
+#   ('eqor', key, val)   -- str: absent or equal to val
+#   ('sup', key, vals)   -- set: present and a superset of vals
+#   ('sub', key, vals)   -- set: absent or a subset of vals
+#   ('count', key, num)  -- set: at least num members
+#   ('notin', key, vals) -- str: present and not one of vals
+#   ('lt', key, num)     -- int: (0 if absent) less than num
+#   ('gt', key, num)     -- int: (0 if absent) greater than num
+#
+# The effect maps keys to (op, arg) pairs: ('set', val) (where a val of
+# None deletes the key), ('add', num), ('union', vals), ('diff', vals).
+# A Reset clears the whole state first.
+
+def atom_holds(atom, dic):
+    '''Test one guard atom against a state dict.
+    '''
+    (op, key, arg) = atom
+    val = dic.get(key)
+    if (op == 'has'):
+        return (val is not None)
+    if (op == 'not'):
+        return (val is None)
+    if (op == 'ge'):
+        return (val is not None and val >= arg)
+    if (op == 'le'):
+        return (val is None or val <= arg)
+    if (op == 'eq'):
+        return (val == arg)
+    if (op == 'eqor'):
+        return (val is None or val == arg)
+    if (op == 'sup'):
+        return (val is not None and val.issuperset(arg))
+    if (op == 'sub'):
+        return (val is None or val.issubset(arg))
+    if (op == 'count'):
+        return (len(val or ()) >= arg)
+    if (op == 'notin'):
+        return (val is not None and val not in arg)
+    if (op == 'lt'):
+        return ((val or 0) < arg)
+    if (op == 'gt'):
+        return ((val or 0) > arg)
+    raise Exception('Unknown guard atom: %s' % (op,))
+
+def quality_atom(scenario, key, val, atleast):
+    '''Return the atom for a Has-style test of one quality: "atleast" if
+    the quality has positive sense, "atmost" if not. (See State.atleast
+    and State.atmost.) Return True if the test always succeeds.
+    '''
+    typ = scenario._typemap[key]
+    if (atleast):
+        if (not val):
+            return True
+        if (typ is bool):
+            return ('has', key, None)
+        if (typ is int):
+            return ('ge', key, val)
+        if (typ is set):
+            return ('sup', key, frozenset(val))
+        return ('eq', key, val)
+    else:
+        if (not val):
+            return ('not', key, None)
+        if (typ is bool):
+            return True
+        if (typ is int):
+            return ('le', key, val)
+        if (typ is set):
+            return ('sub', key, frozenset(val))
+        return ('eqor', key, val)
+
+class ActionCompiler:
+    '''ActionCompiler: Reduces one action tree to a guard and an effect.
+    Call compile(action); the result is in the guard, effect, reset, and
+    never attributes. If the tree contains something we can't reduce
+    (a Choice, or a custom Action class), compile() returns False.
+    '''
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.guard = []
+        self.effect = {}
+        self.reset = False
+        self.never = False
+
+    def compile(self, action):
+        meth = getattr(self, 'compile_'+type(action).__name__, None)
+        if (meth is None or type(action) not in ACTION_CLASSES):
+            return False
+        return meth(action)
+
+    def written(self, key):
+        '''Return the value that the effect so far leaves in key, as a
+        state dict of zero or one entries. Return None if the key is
+        untouched or changed in a relative way.
+        '''
+        eff = self.effect.get(key)
+        if (eff is None):
+            if (self.reset):
+                return {}
+            return None
+        (op, arg) = eff
+        if (op != 'set'):
+            return None
+        if (arg is None):
+            return {}
+        return { key: arg }
+
+    def add_clause(self, atoms):
+        '''Add a guard clause (a list of atoms, any of which must hold).
+        Atoms on keys that the effect has already written are decided
+        now. Return False if that's not possible.
+        '''
+        clause = []
+        for atom in atoms:
+            if (atom is True):
+                return True
+            key = atom[1]
+            if (key in self.effect or self.reset):
+                dic = self.written(key)
+                if (dic is None):
+                    return False
+                if (atom_holds(atom, dic)):
+                    return True
+                continue
+            clause.append(atom)
+        if (not clause):
+            self.never = True
+            return True
+        self.guard.append(tuple(clause))
+        return True
+
+    def add_effect(self, key, op, arg):
+        '''Add a change to the effect, folding it into any earlier change
+        to the same key. Return False if that's not possible.
+        '''
+        old = self.effect.get(key)
+        if (op == 'set' or (old is None and not self.reset)):
+            self.effect[key] = (op, arg)
+            return True
+        if (old is None):
+            old = ('set', None)
+        (oldop, oldarg) = old
+        if (oldop == 'set'):
+            if (op == 'add'):
+                val = (oldarg or 0) + arg
+            elif (op == 'union'):
+                val = (oldarg or frozenset()).union(arg)
+            else:
+                val = (oldarg or frozenset()).difference(arg)
+            self.effect[key] = ('set', (val or None))
+            return True
+        if (oldop == op and op in ('add', 'union')):
+            if (op == 'add'):
+                self.effect[key] = (op, oldarg+arg)
+            else:
+                self.effect[key] = (op, oldarg.union(arg))
+            return True
+        return False
+
+    def compile_Has(self, action):
+        sensemap = self.scenario._sensemap
+        for (key, val) in action.params.items():
+            atom = quality_atom(self.scenario, key, val, sensemap[key])
+            if (not self.add_clause([atom])):
+                return False
+        return True
+
+    def compile_HasAny(self, action):
+        sensemap = self.scenario._sensemap
+        atoms = [ quality_atom(self.scenario, key, val, sensemap[key]) for (key, val) in action.params.items() ]
+        return self.add_clause(atoms)
+
+    def compile_Set(self, action):
+        for (key, val) in action.params.items():
+            if (not val):
+                val = None
+            elif (type(val) in (tuple, list)):
+                val = frozenset(val)
+            self.add_effect(key, 'set', val)
+        return True
+
+    def compile_Reset(self, action):
+        self.reset = True
+        self.effect = {}
+        for (key, val) in action.params.items():
+            self.add_effect(key, 'set', val)
+        return True
+
+    def compile_Lose(self, action):
+        for key in action.keys:
+            if (not self.add_clause([('has', key, None)])):
+                return False
+        for key in action.keys:
+            self.add_effect(key, 'set', None)
+        return True
+
+    def compile_Once(self, action):
+        if (not self.scenario._sensemap[action.key]):
+            if (not self.add_clause([('not', action.key, None)])):
+                return False
+            self.add_effect(action.key, 'set', True)
+        else:
+            if (not self.add_clause([('has', action.key, None)])):
+                return False
+            self.add_effect(action.key, 'set', None)
+        if (action.action):
+            return self.compile(action.action)
+        return True
+
+    def compile_Increment(self, action):
+        if (action.limit is not None):
+            if (not self.add_clause([('lt', action.key, action.limit)])):
+                return False
+        return self.add_effect(action.key, 'add', 1)
+
+    def compile_Decrement(self, action):
+        if (action.limit is not None):
+            if (not self.add_clause([('gt', action.key, action.limit)])):
+                return False
+        return self.add_effect(action.key, 'add', -1)
+
+    def compile_Include(self, action):
+        if (not action.values):
+            return False
+        return self.add_effect(action.key, 'union', action.values)
+
+    def compile_Exclude(self, action):
+        if (not action.values):
+            return False
+        if (not self.add_clause([('sup', action.key, action.values)])):
+            return False
+        return self.add_effect(action.key, 'diff', action.values)
+
+    def compile_Count(self, action):
+        return self.add_clause([('count', action.key, action.count)])
+
+    def compile_HasDifferent(self, action):
+        return self.add_clause([('notin', action.key, action.values)])
+
+    def compile_Chain(self, action):
+        for subaction in action.actions:
+            if (not self.compile(subaction)):
+                return False
+        return True
+
+class CompiledAction:
+    '''CompiledAction: The fast form of an action, built by
+    compile_action(). Calling it on a state gives the same result as
+    calling the original action, without walking the action tree.
+
+    The guard is split up for speed: keys which must be present, keys
+    which must be absent, other single atoms, and multi-atom clauses.
+    '''
+    def __init__(self, action, compiler):
+        self.action = action
+        self.guard = tuple(compiler.guard)
+        self.effect = compiler.effect
+        self.reset = compiler.reset
+        self.never = compiler.never
+        required = set()
+        forbidden = set()
+        checks = []
+        anyclauses = []
+        for clause in self.guard:
+            if (len(clause) > 1):
+                anyclauses.append(clause)
+                continue
+            atom = clause[0]
+            if (atom[0] == 'has'):
+                required.add(atom[1])
+            elif (atom[0] == 'not'):
+                forbidden.add(atom[1])
+            else:
+                checks.append(atom)
+        self.required = frozenset(required)
+        self.forbidden = frozenset(forbidden)
+        self.checks = tuple(checks)
+        self.anyclauses = tuple(anyclauses)
+        self.dels = tuple([ key for (key, (op, arg)) in self.effect.items() if (op == 'set' and arg is None) ])
+        self.sets = dict([ (key, arg) for (key, (op, arg)) in self.effect.items() if (op == 'set' and arg is not None) ])
+        self.relative = tuple([ (key, op, arg) for (key, (op, arg)) in self.effect.items() if (op != 'set') ])
+        self.reads = frozenset([ atom[1] for clause in self.guard for atom in clause ])
+        self.writes = frozenset(self.effect)
+
+    def witness(self):
+        '''Return one quality which the guard requires to be present, or
+        None if there isn't one.
+        '''
+        for clause in self.guard:
+            if (len(clause) == 1):
+                (op, key, arg) = clause[0]
+                if (op in ('has', 'ge', 'eq', 'sup', 'notin')):
+                    return key
+                if (op == 'count' and arg > 0):
+                    return key
+        return None
+
+    def __repr__(self):
+        return '<CompiledAction "%s">' % (self.action.name,)
+
+    def __call__(self, state):
+        if (self.never):
+            return
+        dic = state.dic
+        keys = dic.keys()
+        if (not keys >= self.required):
+            return
+        if (not keys.isdisjoint(self.forbidden)):
+            return
+        for atom in self.checks:
+            if (not atom_holds(atom, dic)):
+                return
+        for clause in self.anyclauses:
+            for atom in clause:
+                if (atom_holds(atom, dic)):
+                    break
+            else:
+                return
+        if (self.reset):
+            dic = {}
+        else:
+            dic = dic.copy()
+        for key in self.dels:
+            dic.pop(key, None)
+        dic.update(self.sets)
+        for (key, op, arg) in self.relative:
+            if (op == 'add'):
+                val = dic.get(key, 0) + arg
+            elif (op == 'union'):
+                val = dic.get(key, frozenset()).union(arg)
+            else:
+                val = dic.get(key, frozenset()).difference(arg)
+            if (val):
+                dic[key] = val
+            else:
+                dic.pop(key, None)
+        res = State(dic, ())
+        scen = res.scenario
+        if (scen is not None and scen._zobrist is not None and not self.reset):
+            res.hashcache = scen._zobrist.update(hash(state), state.dic, dic, self.writes)
+        return res
+
+def compile_action(action, scenario=None):
+    '''Compile an action tree into a CompiledAction, or return None if the
+    tree can't be reduced. (The scenario's quality universe must be
+    complete, so do this after the scenario class is defined.)
+    '''
+    if (scenario is None):
+        scenario = action.scenario
+    compiler = ActionCompiler(scenario)
+    if (not compiler.compile(action)):
+        return None
+    return CompiledAction(action, compiler)
+
+def compile_actions(scenario):
+    '''Compile every action in the scenario (including the test actions),
+    setting each one's compiled attribute. Actions which can't be
+    compiled are left alone; they'll be called as usual. Return the
+    number of actions compiled.
+    '''
+    actions = list(scenario._actionmap.values())
+    for test in scenario._testmap.values():
+        actions.extend(test.canactions)
+        actions.extend(test.cannotactions)
+    count = 0
+    for action in actions:
+        action.compiled = compile_action(action, scenario)
+        if (action.compiled is not None):
+            count = count+1
+    return count
+
+# Inferring equivtypes.
+#
+# The action classes guess their own equivtype when they're created, but
+# only from what they are (a Set of positive booleans is an improvement).
+# Those guesses are good enough for the run's usual shortcuts, but not to
+# build on: Set(c=False) is called a loss even where c is already
+# absent. So with --equivtypes, we classify the rest from scratch:
+# compile each action (see compile_action) and look at what its effect
+# does to each quality, given what its guard says about that quality
+# beforehand. Each change is SAME, IMPROVE (better or the same), LOSS
+# (certainly worse, or incomparable), or UNKNOWN. One certain loss makes
+# the whole action a loss; otherwise it's the weakest of the changes.
+# Only actions whose equivtype is EQUIV_UNKNOWN are touched, and the
+# guesses of their subactions are never consulted.
+
+def guard_facts(compiled, key):
+    '''Return the atoms on one quality which the compiled guard requires
+    outright (that is, the single-atom clauses).
+    '''
+    return [ clause[0] for clause in compiled.guard if (len(clause) == 1 and clause[0][1] == key) ]
+
+def quality_change(scenario, key, change, atoms):
+    '''Classify one change of an effect (an (op, arg) pair), given the
+    guard atoms on its quality. Return an EQUIV value.
+    '''
+    (op, arg) = change
+    present = False
+    absent = False
+    for (aop, _, aarg) in atoms:
+        if (aop in ('has', 'eq', 'sup', 'notin')):
+            present = True
+        elif (aop == 'ge' and aarg >= 1):
+            present = True
+        elif (aop == 'gt' and aarg >= 0):
+            present = True
+        elif (aop == 'count' and aarg > 0):
+            present = True
+        elif (aop == 'not'):
+            absent = True
+    typ = scenario._typemap.get(key)
+    if (not scenario._sensemap.get(key, True)):
+        # Negative sense: absent (or smaller) is better.
+        if (op == 'set' and arg is None):
+            if (absent):
+                return EQUIV_SAME
+            return EQUIV_IMPROVE
+        if (op == 'set'):
+            if (typ is bool and present):
+                return EQUIV_SAME
+            if (absent):
+                return EQUIV_LOSS
+            return EQUIV_UNKNOWN
+        if (op == 'add'):
+            if (arg > 0):
+                return EQUIV_LOSS
+            if (arg < 0):
+                return EQUIV_IMPROVE
+            return EQUIV_SAME
+        if (op == 'union'):
+            if (absent and arg):
+                return EQUIV_LOSS
+            return EQUIV_UNKNOWN
+        return EQUIV_IMPROVE
+    if (op == 'set' and arg is None):
+        if (absent):
+            return EQUIV_SAME
+        if (present):
+            return EQUIV_LOSS
+        return EQUIV_UNKNOWN
+    if (op == 'set'):
+        if (typ is bool):
+            if (present):
+                return EQUIV_SAME
+            return EQUIV_IMPROVE
+        if (absent):
+            if (typ is int and arg < 0):
+                return EQUIV_LOSS
+            return EQUIV_IMPROVE
+        for (aop, _, aarg) in atoms:
+            if (typ is str):
+                if (aop == 'eq'):
+                    if (aarg == arg):
+                        return EQUIV_SAME
+                    return EQUIV_LOSS
+                if (aop == 'notin' and arg in aarg):
+                    return EQUIV_LOSS
+            elif (typ is int):
+                if (aop == 'le' and aarg <= arg):
+                    return EQUIV_IMPROVE
+                if (aop == 'ge' and aarg > arg):
+                    return EQUIV_LOSS
+                if (aop == 'gt' and aarg >= arg):
+                    return EQUIV_LOSS
+            elif (typ is set):
+                if (aop == 'sub' and aarg.issubset(arg)):
+                    return EQUIV_IMPROVE
+                if (aop == 'sup' and not aarg.issubset(arg)):
+                    return EQUIV_LOSS
+        return EQUIV_UNKNOWN
+    if (op == 'add'):
+        if (arg > 0):
+            return EQUIV_IMPROVE
+        if (arg < 0 and present):
+            return EQUIV_LOSS
+        if (arg == 0):
+            return EQUIV_SAME
+        return EQUIV_UNKNOWN
+    if (op == 'union'):
+        for (aop, _, aarg) in atoms:
+            if (aop == 'sup' and aarg.issuperset(arg)):
+                return EQUIV_SAME
+        return EQUIV_IMPROVE
+    # op == 'diff'
+    if (absent):
+        return EQUIV_SAME
+    for (aop, _, aarg) in atoms:
+        if (aop == 'sup' and not aarg.isdisjoint(arg)):
+            return EQUIV_LOSS
+    return EQUIV_UNKNOWN
+
+def combine_equivtypes(ls):
+    '''Combine the classifications of several changes (or subactions):
+    any LOSS wins; then SAME only if they're all SAME, IMPROVE if they're
+    all SAME or IMPROVE, and otherwise UNKNOWN.
+    '''
+    if (EQUIV_LOSS in ls):
+        return EQUIV_LOSS
+    if (EQUIV_UNKNOWN in ls):
+        return EQUIV_UNKNOWN
+    if (EQUIV_IMPROVE in ls):
+        return EQUIV_IMPROVE
+    return EQUIV_SAME
+
+def infer_equivtype(action, scenario):
+    '''Work out an equivtype for an action from its compiled form (see
+    the comment above), ignoring the equivtypes its classes guessed.
+    Return it. An action which can't be compiled is classified from its
+    subactions, if it's a Choice or Chain; otherwise it's EQUIV_UNKNOWN.
+    '''
+    compiled = compile_action(action, scenario)
+    if (compiled is not None):
+        if (compiled.never):
+            return EQUIV_SAME
+        if (compiled.reset):
+            return EQUIV_UNKNOWN
+        ls = [ quality_change(scenario, key, change, guard_facts(compiled, key)) for (key, change) in compiled.effect.items() ]
+        return combine_equivtypes(ls)
+    if (isinstance(action, Choice)):
+        # Only one of the branches happens, so a loss is only certain
+        # if every branch is a loss.
+        subtypes = [ infer_equivtype(subaction, scenario) for subaction in action.subactions() ]
+        if (subtypes and subtypes.count(EQUIV_LOSS) == len(subtypes)):
+            return EQUIV_LOSS
+        if (EQUIV_LOSS in subtypes):
+            return EQUIV_UNKNOWN
+        return combine_equivtypes(subtypes)
+    if (isinstance(action, Chain)):
+        # A later part may win back what an earlier part lost, so only
+        # improvements carry through a chain.
+        subtypes = [ infer_equivtype(subaction, scenario) for subaction in action.subactions() ]
+        if (EQUIV_LOSS in subtypes):
+            return EQUIV_UNKNOWN
+        return combine_equivtypes(subtypes)
+    return EQUIV_UNKNOWN
+
+def infer_equivtypes(scenario):
+    '''Infer equivtypes for the scenario's EQUIV_UNKNOWN actions (see
+    infer_equivtype), and set them. Return the set of names of the
+    actions which were EQUIV_UNKNOWN before, and aren't now.
+    '''
+    res = set()
+    for action in scenario._actionmap.values():
+        if (action.equivtype != EQUIV_UNKNOWN):
+            continue
+        equivtype = infer_equivtype(action, scenario)
+        if (equivtype != EQUIV_UNKNOWN):
+            action.equivtype = equivtype
+            res.add(action.name)
+    return res
+
+# Regression (backward search).
+#
+# To regress a goal condition through an action is to work out what must
+# be true before the action, for the goal to be true after it. Here a
+# condition is a frozenset of guard atoms (see atom_holds), all of which
+# must hold. We regress through the compiled form of each action: atoms
+# on qualities the effect doesn't touch carry through; atoms on qualities
+# it does touch are worked out from the effect; and the action's own
+# guard is added.
+#
+# The regression is allowed to be too generous (the condition it returns
+# may hold in states that can't really reach the goal), but never too
+# strict. Where we can't work out an atom exactly, we drop it. An action
+# that can't be compiled regresses to the empty condition, which holds
+# everywhere. So a state which satisfies none of the regressed
+# conditions certainly can't reach the goal.
+
+def regress_atom(atom, effect):
+    '''Regress one atom through one change to its quality, an effect
+    (op, arg) pair as in CompiledAction. Return an atom which must hold
+    before the change, or True if nothing is needed, or False if the
+    atom can't hold after the change.
+    '''
+    (op, key, arg) = atom
+    (effop, effarg) = effect
+    if (effop == 'set'):
+        dic = {}
+        if (effarg is not None):
+            dic[key] = effarg
+        return atom_holds(atom, dic)
+    if (effop == 'add'):
+        # Absent counts as 0, so "lt" and "gt" carry through exactly.
+        if (op == 'ge' and arg > 0):
+            return ('gt', key, arg-effarg-1)
+        if (op == 'le' and arg >= 0):
+            return ('lt', key, arg-effarg+1)
+        if (op in ('lt', 'gt')):
+            return (op, key, arg-effarg)
+        return True
+    if (effop == 'union'):
+        if (op == 'has'):
+            return True
+        if (op == 'not'):
+            return False
+        if (op == 'sup'):
+            rest = frozenset(arg).difference(effarg)
+            if (not rest):
+                return True
+            return ('sup', key, rest)
+        if (op == 'sub'):
+            if (not frozenset(effarg).issubset(arg)):
+                return False
+            return atom
+        return True
+    if (effop == 'diff'):
+        if (op == 'sup'):
+            if (frozenset(arg).intersection(effarg)):
+                return False
+            return atom
+        if (op == 'sub'):
+            return ('sub', key, frozenset(arg).union(effarg))
+        if (op in ('has', 'count')):
+            return atom
+        return True
+    return True
+
+def normalize_condition(atoms):
+    '''Turn a list of atoms into a condition (a frozenset), dropping any
+    that are implied by stronger ones on the same quality. Return None
+    if the atoms plainly contradict each other.
+    '''
+    bykey = {}
+    for atom in atoms:
+        bykey.setdefault(atom[1], []).append(atom)
+    res = []
+    for (key, ls) in bykey.items():
+        ops = dict([ (atom[0], atom[2]) for atom in ls ])
+        if ('not' in ops):
+            for op in ('has', 'ge', 'eq', 'sup', 'notin'):
+                if (op in ops):
+                    return None
+        for (op, pick) in (('ge', max), ('gt', max), ('le', min), ('lt', min), ('count', max)):
+            vals = [ atom[2] for atom in ls if atom[0] == op ]
+            if (len(vals) > 1):
+                ls = [ atom for atom in ls if atom[0] != op ] + [ (op, key, pick(vals)) ]
+        if (len(set([ atom[2] for atom in ls if atom[0] == 'eq' ])) > 1):
+            return None
+        res.extend(ls)
+    return frozenset(res)
+
+def regress_condition(cond, compiled):
+    '''Regress a condition through a compiled action (None, if it can't
+    be compiled). Return the condition that must hold before the action,
+    or None if the action can't lead to the condition.
+    '''
+    if (compiled is None):
+        return frozenset()
+    if (compiled.never):
+        return None
+    atoms = []
+    for atom in cond:
+        key = atom[1]
+        if (key in compiled.effect):
+            res = regress_atom(atom, compiled.effect[key])
+        elif (compiled.reset):
+            res = regress_atom(atom, ('set', None))
+        else:
+            res = atom
+        if (res is False):
+            return None
+        if (res is not True):
+            atoms.append(res)
+    for clause in compiled.guard:
+        # Multi-atom clauses are dropped (that's too generous, but safe).
+        if (len(clause) == 1):
+            atoms.append(clause[0])
+    return normalize_condition(atoms)
+
+def atom_implies(atom, other):
+    '''Return whether one guard atom implies another. (This only knows
+    about the simple cases; a False answer just means we can't tell.)
+    '''
+    if (atom == other):
+        return True
+    (op, key, arg) = atom
+    (oop, okey, oarg) = other
+    if (key != okey):
+        return False
+    if (oop == 'has'):
+        return (op in ('ge', 'eq', 'sup', 'notin') or (op == 'gt' and arg >= 0))
+    if (oop == 'gt'):
+        return ((op == 'gt' and arg >= oarg) or (op == 'ge' and arg > oarg))
+    if (oop == 'ge'):
+        return ((op == 'ge' and arg >= oarg) or (op == 'gt' and arg >= oarg and oarg > 0))
+    if (oop == 'lt'):
+        return ((op == 'lt' and arg <= oarg) or (op == 'le' and arg < oarg and oarg > 0))
+    if (oop == 'le'):
+        return ((op == 'le' and arg <= oarg) or (op == 'lt' and arg <= oarg+1 and oarg >= 0) or op == 'not')
+    if (oop == 'sup'):
+        return (op == 'sup' and arg.issuperset(oarg))
+    if (oop == 'sub'):
+        return ((op == 'sub' and arg.issubset(oarg)) or op == 'not')
+    if (oop == 'count'):
+        return (op == 'count' and arg >= oarg)
+    if (oop == 'eqor'):
+        return (op in ('eq', 'not') and (op == 'not' or arg == oarg))
+    return False
+
+def condition_implies(cond, other):
+    '''Return whether one condition implies another: every atom of the
+    other is implied by some atom of the first.
+    '''
+    for oatom in other:
+        for atom in cond:
+            if (atom_implies(atom, oatom)):
+                break
+        else:
+            return False
+    return True
+
+class RegressionSearch:
+    '''RegressionSearch: A backward search from a goal condition (a list
+    of atoms), through a list of actions. The result is a set of
+    conditions; a state can only reach the goal (by any sequence of
+    those actions) if it satisfies one of them. See regress_condition.
+
+    We keep only the weakest conditions: if one condition implies
+    another, the first is redundant. If the search turns up
+    more than limit conditions, it gives up, and every state is taken to
+    be able to reach the goal; complete is then False.
+
+    Regressing through Increment or Decrement over and over gives ever
+    weaker number atoms ("more than 0 coins", "more than -1 coins"...).
+    To make sure the search ends, number atoms whose argument is bigger
+    (either way) than any number the actions mention are dropped.
+    '''
+    def __init__(self, scenario, actions, goal, limit=10000):
+        compiled = []
+        self.bound = 1
+        for action in actions:
+            comp = action.compiled
+            if (comp is None):
+                comp = compile_action(action, scenario)
+            compiled.append(comp)
+            if (comp is not None):
+                nums = [ atom[2] for clause in comp.guard for atom in clause ]
+                nums.extend([ arg for (op, arg) in comp.effect.values() ])
+                for num in nums:
+                    if (type(num) is int):
+                        self.bound = max(self.bound, abs(num)+1)
+        self.conditions = set()
+        self.complete = True
+        queue = collections.deque()
+        cond = normalize_condition(goal)
+        if (cond is not None):
+            self.insert(cond)
+            queue.append(cond)
+        while (queue):
+            if (len(self.conditions) > limit):
+                self.conditions = set([ frozenset() ])
+                self.complete = False
+                break
+            cond = queue.popleft()
+            if (cond not in self.conditions):
+                continue
+            keys = set([ atom[1] for atom in cond ])
+            for comp in compiled:
+                if (comp is not None and not comp.reset and keys.isdisjoint(comp.writes)):
+                    continue
+                newcond = regress_condition(cond, comp)
+                if (newcond is None):
+                    continue
+                newcond = frozenset([ atom for atom in newcond if not (atom[0] in ('ge', 'gt', 'le', 'lt') and abs(atom[2]) > self.bound) ])
+                if (self.insert(newcond)):
+                    queue.append(newcond)
+
+    def insert(self, cond):
+        '''Add a condition, unless a weaker one is already present.
+        Return whether it was added.
+        '''
+        for other in self.conditions:
+            if (condition_implies(cond, other)):
+                return False
+        self.conditions = set([ other for other in self.conditions if not condition_implies(other, cond) ])
+        self.conditions.add(cond)
+        return True
+
+    def can_reach(self, state):
+        '''Return whether a state satisfies one of the conditions (so it
+        might reach the goal).
+        '''
+        dic = state.dic
+        for cond in self.conditions:
+            for atom in cond:
+                if (not atom_holds(atom, dic)):
+                    break
+            else:
+                return True
+        return False
+
+# Saving and loading runs.
+#
+# A run's results depend only on the scenario's qualities, the start
+# states, the actions (and what they do), and a few of the run options.
+# run_fingerprint() boils all of that down to a string. A graph saved
+# under one fingerprint can be loaded in place of any run with the same
+# fingerprint.
+
+# The Graph.run() options which can change the resulting graph, or
+# whether the run gets that far (the limit). The others only change how
+# fast we get there.
+RESULT_OPTIONS = ('limit', 'noopt', 'frontier', 'prune', 'partialorder', 'saturate', 'sparse', 'fixed')
+
+# The write buffer size for exported graph files.
+EXPORT_BUFFER = 1 << 18
+
+# Bump this when the saved graph format changes.
+SAVE_VERSION = 4
+
+def value_signature(val, rename=None):
+    '''Return a stable description of a value, made of tuples and
+    strings. Sets and dicts are sorted (their iteration order can vary
+    between processes); actions are described by action_signature().
+    If rename is a dict, strings found in it are replaced (see
+    find_symmetry).
+    '''
+    if (isinstance(val, Action)):
+        return action_signature(val, rename)
+    if (type(val) in (tuple, list)):
+        return tuple([ value_signature(subval, rename) for subval in val ])
+    if (type(val) in (set, frozenset)):
+        ls = [ repr(value_signature(subval, rename)) for subval in val ]
+        ls.sort()
+        return ('set',) + tuple(ls)
+    if (type(val) is dict):
+        ls = [ (value_signature(key, rename), value_signature(subval, rename)) for (key, subval) in val.items() ]
+        ls.sort()
+        return ('dict',) + tuple(ls)
+    if (isinstance(val, type)):
+        return val.__name__
+    if (rename and type(val) is str):
+        val = rename.get(val, val)
+    return repr(val)
+
+def action_signature(action, rename=None):
+    '''Return a stable description of what an action does: its class and
+    parameters, and those of its subactions. For action classes defined
+    outside PlotEx, the class source is included too, since we can't
+    otherwise tell what __call__ does.
+    '''
+    cla = type(action)
+    ls = [ cla.__name__ ]
+    if (cla.__module__ != __name__):
+        try:
+            source = inspect.getsource(cla)
+            ls.append(hashlib.sha1(source.encode('utf-8')).hexdigest())
+        except (OSError, TypeError):
+            ls.append(repr(cla))
+    keyls = list(vars(action).keys())
+    keyls.sort()
+    for key in keyls:
+        if (key in ('name', 'scenario', 'compiled', 'typelist', 'equivtype')):
+            continue
+        ls.append( (key, value_signature(getattr(action, key), rename)) )
+    return tuple(ls)
+
+def action_signatures(actions):
+    '''Return a dict mapping each action's name to a hash of its
+    action_signature().
+    '''
+    res = {}
+    for action in actions:
+        sig = repr(action_signature(action))
+        res[action.name] = hashlib.sha1(sig.encode('utf-8')).hexdigest()
+    return res
+
+def run_fingerprint(scenario, startstates, actions, runopts):
+    '''Return a pair of strings identifying a run. The first covers the
+    run's configuration: start states, which of the scenario's actions
+    are blocked, and the options that affect the result. The second
+    covers all that plus the qualities and what each action does. Runs
+    with the same second string produce the same graph.
+    '''
+    starts = [ repr(value_signature(state.dic)) for state in startstates ]
+    starts.sort()
+    names = set([ action.name for action in actions ])
+    blocked = [ name for name in scenario._actionmap if name not in names ]
+    blocked.sort()
+    opts = [ (key, value_signature(runopts.get(key))) for key in RESULT_OPTIONS ]
+    symmetry = None
+    if (scenario._symmetry is not None):
+        symmetry = (tuple(scenario._symmetry.groups), scenario._symmetry.detect)
+    inferred = None
+    if (scenario._inferred is not None):
+        inferred = tuple(sorted(scenario._inferred))
+    config = repr( (tuple(starts), tuple(blocked), tuple(opts), symmetry, inferred) )
+    types = [ (key, typ.__name__) for (key, typ) in scenario._typemap.items() if key is not None ]
+    types.sort()
+    sigs = list(action_signatures(actions).items())
+    sigs.sort()
+    full = repr( (config, tuple(types), tuple(sigs)) )
+    return (hashlib.sha1(config.encode('utf-8')).hexdigest(),
+            hashlib.sha1(full.encode('utf-8')).hexdigest())
+
+def read_saved_graph(filename):
+    '''Read the data written by Graph.save(). Return None if the file is
+    missing, unreadable, or in an old format.
+    '''
+    try:
+        fl = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        data = pickle.load(fl)
+    except Exception:
+        return None
+    finally:
+        fl.close()
+    if (type(data) is not dict or data.get('version') != SAVE_VERSION):
+        return None
+    return data
+
+def load_graph(scenario, startstates, actions, filename, fingerprint):
+    '''Load a graph saved by Graph.save(). Return None if the file is
+    missing, unreadable, or has a different fingerprint.
+    '''
+    data = read_saved_graph(filename)
+    if (data is None or data['fingerprint'] != fingerprint):
+        return None
+    graph = Graph(scenario, startstates)
+    graph.restore(data, actions)
+    return graph
+
+def cached_run(scenario, startstates, actions, cachedir, incremental=False, **runopts):
+    '''Do a run, like Graph.run(), keeping the results in cachedir. If
+    the cache holds a run with the same fingerprint, load that instead
+    of running again. (There is one cache file per run configuration;
+    when the scenario changes, the file is replaced.) Return the graph.
+
+    If incremental is true and the cached run differs only in what some
+    actions do, the new run reuses whatever parts of the old one the
+    changes can't have affected. (See PriorRun.)
+    '''
+    (confkey, fingerprint) = run_fingerprint(scenario, startstates, actions, runopts)
+    filename = os.path.join(cachedir, 'plotex-%s.graph' % (confkey,))
+    data = read_saved_graph(filename)
+    if (data is not None and data['fingerprint'] == fingerprint):
+        graph = Graph(scenario, startstates)
+        graph.restore(data, actions, runopts.get('fixed', ()))
+        return graph
+    signatures = action_signatures(actions)
+    if (data is not None and incremental):
+        oldsigs = data['signatures']
+        changed = set([ name for (name, sig) in signatures.items() if oldsigs.get(name) != sig ])
+        runopts['prior'] = PriorRun(scenario, data, changed)
+    graph = Graph(scenario, startstates)
+    graph.run(actions, **runopts)
+    if (not os.path.isdir(cachedir)):
+        os.makedirs(cachedir)
+    graph.save(filename, fingerprint, signatures)
+    return graph
+
+class PriorRun:
+    '''PriorRun: The improvement steps found by an earlier run (as saved
+    by Graph.save), for re-exploring after some actions were edited.
+
+    In the old run, each state either was maximal or was improved by
+    the first improving action in the list. That step is still right
+    in the new run if the action is unchanged, and if none of the
+    changed (or new) actions ahead of it in the list improves the state
+    either. Checking that takes one call per changed action, rather
+    than one per action.
+
+    (Change actions are always re-applied; that's cheap next to finding
+    maximal states.)
+    '''
+    def __init__(self, scenario, data, changed):
+        self.changed = changed
+        self.steps = {}
+        for (dic, val) in zip(data['states'], data['nodes']):
+            maxing = val[2]
+            if (maxing):
+                self.steps[make_state(scenario, dic)] = maxing[0]
+            else:
+                self.steps[make_state(scenario, dic)] = None
+        self.reused = 0
+        self.rejected = 0
+
+    def bind(self, actions):
+        '''Get ready to check steps against a bound list of improve
+        actions (see Graph.bind).
+        '''
+        self.actions = actions
+        self.actionpos = {}
+        self.checks = []
+        for (pos, (action, func)) in enumerate(actions):
+            self.actionpos[action.name] = pos
+            if (action.name in self.changed):
+                self.checks.append( (pos, func) )
+
+    def positions(self, state):
+        '''Return the improve action positions that find_maximal_state()
+        needs to try on this state: an empty list if the state is still
+        maximal, or a list of one if the old step is still right. If the
+        old run doesn't help, return None.
+        '''
+        if (state not in self.steps):
+            return None
+        name = self.steps[state]
+        if (name is None):
+            limit = len(self.actions)
+        else:
+            limit = self.actionpos.get(name)
+            if (limit is None or name in self.changed):
+                self.rejected += 1
+                return None
+        for (pos, func) in self.checks:
+            if (pos >= limit):
+                break
+            newstate = func(state)
+            if (newstate and newstate != state and newstate > state):
+                self.rejected += 1
+                return None
+        self.reused += 1
+        if (name is None):
+            return []
+        return [limit]
+
+def make_state(scenario, dic):
+    '''Create a state from a dict which is already canonized. (This is
+    how states come back from worker processes.)
+    '''
+    state = State()
+    state.scenario = scenario
+    state.dic = dic
+    if (scenario._statetable is not None):
+        state = scenario._statetable.intern(state)
+    return state
+
+# The worker processes of a pool inherit this when they are forked. It
+# holds whatever the worker functions need: for expand_state_worker, the
+# scenario and the improve and change action lists; for run_test_worker,
+# the test list, test groups, run options, and goal-directed flag.
+worker_context = None
+
+def start_pool(workers, context):
+    '''Start a pool of worker processes, which will see the given context
+    in worker_context. The workers are forked, so scenario classes and
+    actions don't have to be pickled. If the platform can't fork, return
+    None (and the caller should do the work itself).
+    '''
+    global worker_context
+    try:
+        ctx = multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+    worker_context = context
+    return ctx.Pool(workers)
+
+def stop_pool(pool):
+    global worker_context
+    pool.terminate()
+    pool.join()
+    worker_context = None
+
+# Each worker process remembers the improvement steps it has worked out,
+# as a map from state to (action index, better state), or None if the
+# state is maximal.
+worker_steps = {}
+
+def expand_state_worker(dic):
+    '''Apply every change action to the given state. For each one, return
+    None (if the action didn't apply) or the chain of improvements that
+    leads from the new state to its maximal state, as a list of state
+    dicts and a list of improve action indexes. (See Graph.merge_chain.)
+    '''
+    (scenario, improveactions, changeactions) = worker_context
+    oldstate = make_state(scenario, dic)
+    res = []
+    for (action, func) in changeactions:
+        state = func(oldstate)
+        if (not state):
+            res.append(None)
+            continue
+        dicls = [ state.dic ]
+        acposls = []
+        while True:
+            if (state in worker_steps):
+                step = worker_steps[state]
+            else:
+                step = None
+                for (pos, (improve, func)) in enumerate(improveactions):
+                    newstate = func(state)
+                    if (not newstate):
+                        continue
+                    if (newstate == state):
+                        continue
+                    if not(newstate > state):
+                        continue
+                    step = (pos, newstate)
+                    break
+                worker_steps[state] = step
+            if (step is None):
+                break
+            (pos, state) = step
+            acposls.append(pos)
+            dicls.append(state.dic)
+        res.append( (dicls, acposls) )
+    return res
+
+class TestGoal:
+    '''TestGoal: The goal of a goal-directed run (see Graph.run): to find
+    a state which satisfies each of a group of positive tests (see
+    Test.is_positive).
+
+    The score of a state, which steers the search, is how many of the
+    wanted qualities it has and how many of the wanted actions it can
+    do, counting only the tests which haven't been satisfied yet.
+    '''
+    def __init__(self, tests):
+        self.waiting = list(tests)
+        self.pos = 0
+        self.canfuncs = {}
+
+    def testfuncs(self, graph, test):
+        '''Return the functions for a test's can actions (see
+        Graph.actfunc). They're worked out once, on the first call; a
+        TestGoal is only used for one graph.
+        '''
+        funcs = self.canfuncs.get(test)
+        if (funcs is None):
+            funcs = test.canfuncs(graph)
+            self.canfuncs[test] = funcs
+        return funcs
+
+    def score(self, graph, state):
+        count = 0
+        for test in self.waiting:
+            for qual in test.getqualities:
+                if (qual in state.dic):
+                    count = count+1
+            for func in self.testfuncs(graph, test):
+                if (func(state)):
+                    count = count+1
+        return count
+
+    def reached(self, graph):
+        '''Check the states added to the graph since the last call.
+        Return whether every test has been satisfied.
+        '''
+        while (self.pos < len(graph.statels)):
+            state = graph.statels[self.pos]
+            self.pos = self.pos+1
+            self.waiting = [ test for test in self.waiting if not test.satisfies(graph, state, self.testfuncs(graph, test)) ]
+        return not self.waiting
+
+def run_tests(tests, workers=1, goaldirected=False, **runopts):
+    '''Check each of a list of tests. This is a generator which yields
+    True or False for each test, in order. Any other keyword arguments
+    are passed along to Graph.run().
+
+    If goaldirected is true, groups made up of positive tests (see
+    Test.is_positive) do a goal-directed run, which stops as soon as
+    every test in the group has passed.
+
+    Tests with the same start states and blocked actions are grouped, so
+    that each distinct run is only done once; every test in the group is
+    verified against the same graph.
+
+    If workers is more than 1, the groups are spread across a pool of
+    worker processes. (Each group still does a single-process run.) If
+    there's only one group, its run uses the workers instead.
+    '''
+    groupmap = {}
+    groups = []
+    for (pos, test) in enumerate(tests):
+        key = test.runkey()
+        group = groupmap.get(key)
+        if (group is None):
+            group = []
+            groupmap[key] = group
+            groups.append(group)
+        group.append(pos)
+
+    pool = None
+    if (workers > 1 and len(groups) > 1):
+        pool = start_pool(workers, (tests, groups, runopts, goaldirected))
+    elif (workers > 1):
+        runopts = dict(runopts, workers=workers)
+    try:
+        if (pool is None):
+            groupresults = ( check_test_group(tests, group, runopts, goaldirected) for group in groups )
+        else:
+            groupresults = pool.imap(run_test_worker, range(len(groups)))
+        results = {}
+        for pos in range(len(tests)):
+            while (pos not in results):
+                results.update(next(groupresults))
+            yield results.pop(pos)
+    finally:
+        if (pool is not None):
+            stop_pool(pool)
+
+def fixed_qualities(tests):
+    '''Return the qualities which a run for these tests must leave out of
+    its symmetry groups: the ones the tests look at. (A canonical state
+    may have a different member of a group than the test asks for.)
+    Return None if any test looks at histories; a run with symmetry
+    groups records its steps from canonical states, so those tests
+    can't be checked against it.
+    '''
+    res = set()
+    for test in tests:
+        quals = test.qualities()
+        if (quals is None):
+            return None
+        res.update(quals)
+    return frozenset(res)
+
+def check_test_group(tests, group, runopts, goaldirected=False):
+    '''Do one run for a group of tests (given as indexes into the tests
+    list) which share start states and blocked actions. Return a dict
+    mapping each index to whether that test passed.
+
+    If the run would prune dominated states, but some test in the group
+    can't be checked that way (see Test.allows_pruning), the group is
+    run without pruning.
+    '''
+    grouptests = [ tests[pos] for pos in group ]
+    if (runopts.get('prune') and not all([ test.allows_pruning() for test in grouptests ])):
+        runopts = dict(runopts, prune=False)
+    goal = None
+    if (goaldirected):
+        if (all([ test.is_positive() for test in grouptests ])):
+            goal = TestGoal(grouptests)
+    graph = tests[group[0]].explore(goal=goal, fixed=fixed_qualities(grouptests), **runopts)
+    verify = (lambda test: test.verify(graph))
+    profile = graph.scenario._profile
+    if (profile is not None):
+        verify = profile.timed('verify', verify)
+    return dict( (pos, verify(tests[pos])) for pos in group )
+
+def run_test_worker(pos):
+    '''Check one group of the tests passed to run_tests(), by index.
+    '''
+    (tests, groups, runopts, goaldirected) = worker_context
+    return check_test_group(tests, groups[pos], runopts, goaldirected)
+
+def reach_goal(scenario, startstates, actions, quals, **runopts):
+    '''Find out whether any state with all the given qualities can be
+    reached, and print the answer. This is a bidirectional search: a
+    RegressionSearch works back from the goal, and then a goal-directed
+    run works forward from the start states, leaving out states which
+    the backward search has ruled out. (The backward search alone is
+    only approximate; the answer comes from the forward run, so it's
+    exact.) Any other keyword arguments are passed along to Graph.run().
+    '''
+    test = Test(gets=quals)
+    test.name = 'reach'
+    test.set_scenario(scenario)
+    goal = [ ('has', qual, None) for qual in quals ]
+    search = RegressionSearch(scenario, actions, goal, runopts.get('limit', 10000))
+    graph = Graph(scenario, startstates)
+    forward = bool([ state for state in startstates if search.can_reach(state) ])
+    if (forward):
+        graph.run(actions, goal=TestGoal([test]), reach=search, fixed=quals, **runopts)
+    canfuncs = test.canfuncs(graph)
+    witnesses = [ state for state in graph.statels if test.satisfies(graph, state, canfuncs) ]
+    if (witnesses):
+        state = witnesses[0]
+        node = graph.states[state]
+        print(state)
+        if (node.is_maximal):
+            history = graph.history(node)
+            acs = [ ac.name for ac in history ]
+            print('  (%d): %s' % (len(history), ', '.join(acs),))
+        print()
+        print('"%s" can be reached' % ('", "'.join(quals),))
+    else:
+        print('"%s" cannot be reached' % ('", "'.join(quals),))
+    if (not forward):
+        print('(the start states were ruled out by backward search)')
+    elif (search.complete):
+        print('(%d states ruled out by backward search)' % (len(graph.pruned),))
+    else:
+        print('(backward search gave up; searched forward only)')
+
 # This is only set while a particular scenario is being processed.
 # We can take shortcuts within state generation when global_scenario
 # is set, because no new qualities will be introduced.
 global_scenario = None
     
+def show_equivtypes(scenario):
+    '''Display the equivtype of each action, noting the ones which were
+    inferred (see infer_equivtypes), and a summary.
+    '''
+    names = list(scenario._actionmap.keys())
+    names.sort()
+    counts = collections.Counter()
+    for name in names:
+        action = scenario._actionmap[name]
+        counts[action.equivtype] += 1
+        val = ''
+        if (name in scenario._inferred):
+            val = ' (inferred)'
+        print('%s %s%s' % (action.equivtype, name, val))
+    print()
+    print('%d actions: %d improve, %d same, %d loss, %d unknown (%d inferred)' % (len(names), counts[EQUIV_IMPROVE], counts[EQUIV_SAME], counts[EQUIV_LOSS], counts[EQUIV_UNKNOWN], len(scenario._inferred)))
+
+def show_reports(scenario, profilejson=None):
+    '''Display the statistics of the scenario's ActionCache, StateTable,
+    and RunProfile (whichever it has). If profilejson is given, the
+    profile is also written there as JSON.
+    '''
+    if (scenario._actioncache is not None):
+        print(scenario._actioncache.report())
+    if (scenario._statetable is not None):
+        print(scenario._statetable.report())
+    if (scenario._profile is not None):
+        print()
+        for line in scenario._profile.report():
+            print(line)
+        if (profilejson):
+            fl = open(profilejson, 'w')
+            try:
+                json.dump(scenario._profile.asdict(), fl, indent=1, sort_keys=True)
+                fl.write('\n')
+            finally:
+                fl.close()
+
 def shell(scenario):
     '''This is the top-level function; it processes the command-line options,
     sets up the graph, and does the run.
@@ -1232,6 +4428,12 @@ def shell(scenario):
     popt.add_option('--graphml',
                     action='store', dest='graphml', metavar='FILE',
                     help='create a GML (.gml) file')
+    popt.add_option('--jsonl',
+                    action='store', dest='jsonl', metavar='FILE',
+                    help='create a JSON Lines (.jsonl) file')
+    popt.add_option('--npz',
+                    action='store', dest='npz', metavar='FILE',
+                    help='create a NumPy (.npz) file of the graph in CSR form')
     popt.add_option('-f', '--filter',
                     action='append', dest='filters', metavar='QUALITIES',
                     default=[],
@@ -1240,14 +4442,104 @@ def shell(scenario):
                     action='append', dest='histories', metavar='ACTIONS',
                     default=[],
                     help='display only states that passed through this action')
+    popt.add_option('--goal-directed',
+                    action='store_true', dest='goaldirected',
+                    help='when running tests, stop as soon as the tests are known to pass')
+    popt.add_option('--reach',
+                    action='append', dest='reach', metavar='QUALITIES',
+                    default=[],
+                    help='find out whether a state with these qualities can be reached')
+    popt.add_option('--equivtypes',
+                    action='store_true', dest='equivtypes',
+                    help='classify the unclassified actions for optimization, and display how each action is classified')
     popt.add_option('--noopt',
                     action='store_true', dest='noopt',
                     help='do not optimize the run based on action type')
+    popt.add_option('--frontier',
+                    action='store', type='choice', dest='frontier', metavar='POLICY',
+                    choices=sorted(FRONTIER_POLICIES), default='bfs',
+                    help='order in which to expand states: bfs, dfs, priority (default: bfs)')
+    popt.add_option('-j', '--jobs',
+                    action='store', type=int, dest='jobs', default=1,
+                    help='number of worker processes to use (default: 1)')
+    popt.add_option('--index',
+                    action='store_true', dest='index',
+                    help='only try actions whose preconditions might be met')
+    popt.add_option('--cache',
+                    action='store', type=int, dest='cachesize', metavar='SIZE', default=0,
+                    help='remember up to SIZE action results, and report cache statistics')
+    popt.add_option('--compile',
+                    action='store_true', dest='compile',
+                    help='compile actions into fast guard/effect form')
+    popt.add_option('--cachedir',
+                    action='store', dest='cachedir', metavar='DIR',
+                    help='save run results in DIR, and reuse them if the scenario has not changed')
+    popt.add_option('--prune-dominated',
+                    action='store_true', dest='prune',
+                    help='do not explore states which are worse than a state already found')
+    popt.add_option('--partial-order',
+                    action='store_true', dest='partialorder',
+                    help='do not try independent actions in every order')
+    popt.add_option('--saturate',
+                    action='store_true', dest='saturate',
+                    help='find maximal states with a worklist, applying every improvement as it comes up')
+    popt.add_option('--incremental',
+                    action='store_true', dest='incremental',
+                    help='with --cachedir, reuse the unaffected parts of a cached run after the scenario changes')
+    popt.add_option('--symmetry',
+                    action='store_true', dest='symmetry',
+                    help='find interchangeable qualities, and explore only one arrangement of them')
+    popt.add_option('--zobrist',
+                    action='store_true', dest='zobrist',
+                    help='hash states incrementally, by the qualities that actions change')
+    popt.add_option('--intern',
+                    action='store_true', dest='intern',
+                    help='keep one copy of each distinct state, so states compare by identity')
+    popt.add_option('--spill',
+                    action='store', type=int, dest='spill', metavar='NODES', default=0,
+                    help='keep about NODES graph nodes in memory, and the rest on disk')
+    popt.add_option('--profile',
+                    action='store_true', dest='profile',
+                    help='report how often each action was tried, and where the time went')
+    popt.add_option('--profile-json',
+                    action='store', dest='profilejson', metavar='FILE',
+                    help='like --profile, and also write the report to FILE as JSON')
+    popt.add_option('--compact',
+                    action='store_true', dest='compact',
+                    help='compare and hash states by a compact bitset key')
 
     (opts, args) = popt.parse_args()
+    if (opts.saturate and opts.jobs > 1):
+        popt.error('--saturate cannot be used with --jobs')
 
     genlimit = getattr(scenario, 'genlimit', opts.genlimit)
+    cachedir = getattr(scenario, 'cachedir', opts.cachedir)
+    spill = getattr(scenario, 'spill', opts.spill)
+
+    # This must happen before any state is hashed.
+    if (opts.compact or getattr(scenario, 'compact', False)):
+        scenario._codec = StateCodec(scenario)
+    if (opts.zobrist or getattr(scenario, 'zobrist', False)):
+        scenario._zobrist = ZobristKeys()
+    if (opts.compile or getattr(scenario, 'compile', False)):
+        compile_actions(scenario)
+    if (opts.cachesize > 0):
+        scenario._actioncache = ActionCache(opts.cachesize)
+    if (opts.profile or opts.profilejson):
+        scenario._profile = RunProfile()
+    if (opts.equivtypes):
+        scenario._inferred = infer_equivtypes(scenario)
+    if (opts.intern or getattr(scenario, 'intern', False)):
+        scenario._statetable = StateTable()
+    symmetry = getattr(scenario, 'symmetry', None)
+    if (symmetry or opts.symmetry):
+        scenario._symmetry = Symmetry(scenario, (symmetry or []), detect=opts.symmetry)
     
+    runopts = dict(limit=genlimit, noopt=opts.noopt, frontier=opts.frontier,
+                   workers=opts.jobs, index=opts.index, prune=opts.prune,
+                   partialorder=opts.partialorder, spill=spill,
+                   saturate=opts.saturate)
+
     if (opts.showall):
         opts.showmed = True
         opts.showin = True
@@ -1262,6 +4554,10 @@ def shell(scenario):
 
     blockactions = parse_actions(scenario, opts.blockactions)
 
+    if (opts.equivtypes):
+        show_equivtypes(scenario)
+        print()
+
     runtests = parse_tests(scenario, opts.runtests)
     if (opts.runalltests):
         runtests = list(scenario._testmap.values())
@@ -1270,18 +4566,16 @@ def shell(scenario):
         runtests = list(runtests)
         runtests.sort(key=lambda ac:ac.name)
         errors = 0
-        for test in runtests:
-            actions = test.actions()
-            actions.sort(key=lambda ac:ac.name)
-            graph = Graph(scenario, test.startstates())
-            graph.run(actions, limit=genlimit, noopt=opts.noopt)
-            if test.verify(graph):
+        results = run_tests(runtests, goaldirected=opts.goaldirected, **runopts)
+        for (test, passed) in zip(runtests, results):
+            if passed:
                 print('%s: pass' % (test.name,))
             else:
                 errors = errors+1
                 print('%s: FAIL' % (test.name,))
         if (errors):
             print('%d errors!' % (errors,))
+        show_reports(scenario, opts.profilejson)
         return
              
     withholdactions = None
@@ -1291,8 +4585,40 @@ def shell(scenario):
 
     actions = [ action for action in list(scenario._actionmap.values()) if action not in blockactions ]
     actions.sort(key=lambda ac:ac.name)
-    graph = Graph(scenario, startstates)
-    graph.run(actions, limit=genlimit, noopt=opts.noopt)
+
+    if (opts.reach):
+        quals = []
+        for val in opts.reach:
+            for subval in val.split(','):
+                quals.append(subval.strip())
+        reach_goal(scenario, startstates, actions, quals, **runopts)
+        show_reports(scenario, opts.profilejson)
+        return
+    filters = []
+    for val in opts.filters:
+        for subval in val.split(','):
+            filters.append(subval.strip())
+    histories = []
+    if (opts.histories):
+        histories = parse_actions(scenario, opts.histories)
+
+    # A saturating run can leave out the middle of each chain, unless
+    # those states are displayed or exported.
+    sparse = (opts.saturate and not (opts.showmed or withholdactions or opts.graphviz or opts.graphml or opts.jsonl or opts.npz))
+
+    # The filtered qualities stay out of the symmetry groups, and the
+    # history filter can't be checked against a symmetric run.
+    fixed = ()
+    if (scenario._symmetry is not None):
+        fixed = frozenset(filters)
+        if (histories):
+            fixed = None
+    
+    if (cachedir and not withholdactions):
+        graph = cached_run(scenario, startstates, actions, cachedir, incremental=opts.incremental, sparse=sparse, fixed=fixed, **runopts)
+    else:
+        graph = Graph(scenario, startstates)
+        graph.run(actions, sparse=sparse, fixed=fixed, **runopts)
     if (withholdactions):
         ls = list(graph.allstates)
         ls.reverse()
@@ -1307,22 +4633,27 @@ def shell(scenario):
         for action in withholdactions:
             actions.append(action)
         graph = Graph(scenario, betterls)
-        graph.run(actions, limit=genlimit, noopt=opts.noopt)
+        graph.run(actions, fixed=fixed, **runopts)
 
-    filters = []
-    for val in opts.filters:
-        for subval in val.split(','):
-            filters.append(subval.strip())
-    histories = []
-    if (opts.histories):
-        histories = parse_actions(scenario, opts.histories)
+    start = time.perf_counter()
     graph.display(opts.showmed, opts.showin, opts.showout, opts.showdiff, opts.showcount, filters, histories)
+    if (opts.prune):
+        print('(%d dominated states pruned)' % (len(graph.pruned),))
+    if (graph.spill is not None):
+        print('(%d of %d states spilled to disk)' % (graph.spill.spilled(), len(graph.spill)))
 
     if (opts.graphviz):
         graph.writegv(opts.graphviz, filters, histories)
     if (opts.graphml):
         graph.writegml(opts.graphml, filters, histories)
+    if (opts.jsonl):
+        graph.writejsonl(opts.jsonl, filters, histories)
+    if (opts.npz):
+        graph.writenpz(opts.npz, filters, histories)
+    if (scenario._profile is not None):
+        scenario._profile.addtime('display', time.perf_counter() - start)
 
+    show_reports(scenario, opts.profilejson)
     global_scenario = None
 
 class ScenarioClass(metaclass=TrackMetaClass):